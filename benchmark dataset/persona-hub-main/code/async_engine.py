@@ -0,0 +1,232 @@
+import asyncio
+import random
+import time
+
+import openai
+from response_cache import make_key
+
+
+# errors worth retrying: rate limits, server-side failures and dropped connections
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+def is_retryable(err):
+    if isinstance(err, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(err, openai.APIStatusError):
+        return err.status_code in RETRYABLE_STATUS or err.status_code >= 500
+    return False
+
+
+def retry_after_seconds(err):
+    response = getattr(err, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def estimate_tokens(text):
+    # rough chars-per-token ratio for English text; only used for tokens/min budgeting
+    return max(1, len(text) // 4)
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `per_minute` units per minute.
+
+    A rate of 0 disables the limit. Bursts are capped at one second worth of
+    refill by default. The level may go negative when usage is debited after
+    the fact, which delays later callers until it refills.
+    """
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1.0, self.rate)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        if self.rate <= 0:
+            return
+        # a request larger than the bucket waits for a full bucket and then
+        # charges its whole size, leaving the level negative like debit() does
+        needed = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.level >= needed:
+                    self.level -= amount
+                    return
+                await asyncio.sleep((needed - self.level) / self.rate)
+
+    def debit(self, amount):
+        if self.rate <= 0:
+            return
+        self._refill()
+        self.level -= amount
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def acquire(self, prompt_tokens):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(prompt_tokens)
+
+    def record_usage(self, completion_tokens):
+        self.tokens.debit(completion_tokens)
+
+
+class AsyncChatEngine:
+    """Runs chat completions concurrently with rate limiting and retries.
+
+    `max_in_flight` caps the number of open requests, `rpm`/`tpm` feed the
+    token-bucket limiter and failed requests are retried with full-jitter
+    exponential backoff (honouring `Retry-After` when the server sends one).
+    An optional ResponseCache is consulted before and filled after each call,
+    and an optional metrics.RunMetrics receives every request's latency,
+    usage, retries and finish reason.
+    """
+
+    def __init__(self, client, model, system_prompt, temperature=0.7, max_in_flight=16,
+                 rpm=0, tpm=0, max_retries=8, backoff_base=0.5, backoff_cap=60.0, cache=None, metrics=None):
+        self.client = client
+        self.model = model
+        self.system_prompt = system_prompt
+        self.temperature = temperature
+        self.max_in_flight = max_in_flight
+        self.limiter = RateLimiter(rpm, tpm)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.cache = cache
+        self.metrics = metrics
+
+    def backoff(self, attempt, err):
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        hint = retry_after_seconds(err)
+        return max(delay, hint) if hint is not None else delay
+
+    async def complete(self, user_prompt):
+        return (await self.complete_choice(user_prompt))[0]
+
+    async def complete_choice(self, user_prompt, validate=None, max_tokens=None):
+        """Return (text, finish_reason); cached responses count as finished with "stop".
+
+        `validate(text, finish_reason)` returns None for a usable response (see
+        validation.check_response); cached responses that fail it are ignored
+        and new ones that fail it are not cached.
+        """
+        if self.cache is not None:
+            key = make_key(self.model, self.temperature, self.system_prompt, user_prompt)
+            cached = self.cache.get(key)
+            if cached is not None and (validate is None or validate(cached, "stop") is None):
+                if self.metrics is not None:
+                    self.metrics.count("cache_hits")
+                return cached, "stop"
+        text, finish_reason = await self.request_choice(user_prompt, max_tokens)
+        # truncated responses are not cached, so a later run can try again
+        if self.cache is not None and text is not None and finish_reason != "length" \
+                and (validate is None or validate(text, finish_reason) is None):
+            self.cache.put(key, text)
+        return text, finish_reason
+
+    async def request(self, user_prompt):
+        return (await self.request_choice(user_prompt))[0]
+
+    async def request_choice(self, user_prompt, max_tokens=None):
+        messages = [
+            {"role": "system", "content": f"{self.system_prompt}"},
+            {"role": "user", "content": f"{user_prompt}"}
+        ]
+        prompt_tokens = estimate_tokens(self.system_prompt) + estimate_tokens(user_prompt)
+        attempt = 0
+        waited = backed_off = 0.0
+        while True:
+            start = time.monotonic()
+            await self.limiter.acquire(prompt_tokens)
+            waited += time.monotonic() - start
+            start = time.monotonic()
+            try:
+                completion = await self.client.chat.completions.create(
+                    model=self.model,
+                    temperature=self.temperature,
+                    messages=messages,
+                    **({"max_tokens": max_tokens} if max_tokens else {})
+                )
+            except Exception as err:
+                if self.metrics is not None and getattr(err, "status_code", None) == 429:
+                    self.metrics.count("rate_limited")
+                if not is_retryable(err) or attempt >= self.max_retries:
+                    if self.metrics is not None:
+                        self.metrics.record_error(type(err).__name__)
+                    raise
+                delay = self.backoff(attempt, err)
+                backed_off += delay
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            latency = time.monotonic() - start
+            if completion.usage is not None:
+                self.limiter.record_usage(completion.usage.completion_tokens)
+            choice = completion.choices[0]
+            if self.metrics is not None:
+                usage = completion.usage
+                self.metrics.record_request(
+                    latency,
+                    usage.prompt_tokens if usage is not None else prompt_tokens,
+                    usage.completion_tokens if usage is not None else estimate_tokens(choice.message.content or ""),
+                    retries=attempt, finish_reason=choice.finish_reason, wait=waited, backoff=backed_off)
+            return choice.message.content, choice.finish_reason
+
+    async def map_ordered(self, items, fn):
+        """Yield `fn(item)` results in input order while running them concurrently.
+
+        At most `max_in_flight` calls run at once and at most twice that many
+        results are buffered, so memory stays bounded for arbitrarily long inputs.
+        """
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        window = 2 * self.max_in_flight
+        pending = {}
+        iterator = iter(items)
+        next_submit = 0
+        next_yield = 0
+        exhausted = False
+
+        async def run(item):
+            async with semaphore:
+                return await fn(item)
+
+        try:
+            while True:
+                while not exhausted and len(pending) < window:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[next_submit] = asyncio.ensure_future(run(item))
+                    next_submit += 1
+                if next_yield not in pending:
+                    return
+                result = await pending.pop(next_yield)
+                next_yield += 1
+                yield result
+        finally:
+            for task in pending.values():
+                task.cancel()
+
+    async def generate(self, user_prompts):
+        async for text in self.map_ordered(user_prompts, self.complete):
+            yield text
@@ -0,0 +1,153 @@
+import asyncio
+import time
+import types
+from functools import partial
+
+from metrics import RunMetrics
+from prompt_cache import PrefixTokenizer
+from prompt_templates import token_budgets
+from response_cache import make_key
+
+SYSTEM_PROMPT = "You are a helpful assistant."
+DEFAULT_MAX_TOKENS = 2048
+# prompts are ordered by their length in units of this many tokens before they go to vLLM
+LENGTH_BUCKET = 64
+
+# Every backend has the same interface: generate(requests) takes a list of
+# (template name, persona, user prompt) tuples and returns one
+# (text, finish_reason) per request, in the same order; close() releases it.
+# Responses are capped at the template's token budget, and with a
+# `validate(template name, text, finish_reason)` function only responses it
+# accepts are cached (see validation.check_response).
+
+
+def record_outputs(metrics, outputs, elapsed):
+    """Record vLLM RequestOutputs in `metrics`."""
+    for output in outputs:
+        # RequestOutput.metrics is not filled by every vLLM version; fall back to the duration of the generate call
+        timing = getattr(output, "metrics", None)
+        arrival, finished = getattr(timing, "arrival_time", None), getattr(timing, "finished_time", None)
+        completion = output.outputs[0]
+        metrics.record_request(finished - arrival if arrival and finished else elapsed,
+                               len(output.prompt_token_ids or []), len(completion.token_ids),
+                               finish_reason=completion.finish_reason)
+
+
+class OpenAIBackend:
+    """Chat completions through AsyncChatEngine.
+
+    Each generate() call runs its requests concurrently on one long-lived
+    event loop, so the client's connection pool is reused across calls.
+    Pass `client` to use another OpenAI-compatible client, e.g.
+    mock_backend.MockAsyncOpenAI.
+    """
+
+    def __init__(self, client=None, model="gpt-4o", temperature=0.7, concurrency=16, rpm=0, tpm=0, max_retries=8,
+                 cache=None, metrics=None, max_tokens=None, validate=None):
+        from async_engine import AsyncChatEngine
+
+        if client is None:
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(max_retries=0)   # retries are handled by AsyncChatEngine
+        self.client = client
+        self.model = model
+        self.max_tokens = max_tokens or token_budgets
+        self.validate = validate
+        self.engine = AsyncChatEngine(client, model=model, system_prompt=SYSTEM_PROMPT, temperature=temperature,
+                                      max_in_flight=concurrency, rpm=rpm, tpm=tpm, max_retries=max_retries,
+                                      cache=cache, metrics=metrics)
+        self.loop = asyncio.new_event_loop()
+
+    async def complete(self, request):
+        name, _, user_prompt = request
+        validate = partial(self.validate, name) if self.validate is not None else None
+        return await self.engine.complete_choice(user_prompt, validate, self.max_tokens.get(name))
+
+    async def _generate(self, requests):
+        return [choice async for choice in self.engine.map_ordered(requests, self.complete)]
+
+    def generate(self, requests):
+        return self.loop.run_until_complete(self._generate(requests))
+
+    def close(self):
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+
+
+class VLLMBackend:
+    """Offline generation with vLLM.
+
+    All requests of a generate() call go to the model in one batch, whatever
+    their template; they are grouped by template first so that prompts with
+    the same prefix sit next to each other, then by prompt length, and each
+    template's static prefix is tokenized once by its own PrefixTokenizer.
+    `max_tokens` maps template names to token budgets (prompt_templates.
+    token_budgets by default). `llm` and `tokenizer` can be passed in (e.g.
+    mock_backend.MockLLM and MockTokenizer) instead of loading `model_path`.
+    """
+
+    def __init__(self, model_path, templates, tensor_parallel_size=1, temperature=0.6, top_p=0.95, max_tokens=None,
+                 enable_prefix_caching=True, cache=None, metrics=None, llm=None, tokenizer=None, validate=None):
+        if tokenizer is None:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+        if llm is None:
+            from vllm import LLM, SamplingParams
+            llm = LLM(model=model_path, tensor_parallel_size=tensor_parallel_size,
+                      enable_prefix_caching=enable_prefix_caching)
+        else:
+            SamplingParams = types.SimpleNamespace
+        max_tokens = max_tokens or token_budgets
+        # vLLM takes one SamplingParams per prompt, so every template keeps its own budget within a batch
+        self.sampling_params = {name: SamplingParams(temperature=temperature, top_p=top_p, stop=["<|eot_id|>"],
+                                                     max_tokens=max_tokens.get(name, DEFAULT_MAX_TOKENS))
+                                for name in templates}
+        self.temperature = temperature
+        self.validate = validate
+        self.model = model_path
+        self.llm = llm
+        self.tokenizer = tokenizer
+        self.cache = cache
+        self.metrics = metrics or RunMetrics()
+        self.prefix_tokenizers = {name: PrefixTokenizer(tokenizer, template, self.render, enabled=enable_prefix_caching)
+                                  for name, template in templates.items()}
+
+    def render(self, user_prompt):
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}]
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    def generate(self, requests):
+        results = [None] * len(requests)
+        keys = [None] * len(requests)
+        if self.cache is not None:
+            for i, (_, _, user_prompt) in enumerate(requests):
+                keys[i] = make_key(self.model, self.temperature, SYSTEM_PROMPT, user_prompt)
+                text = self.cache.get(keys[i])
+                if text is not None and (self.validate is None or self.validate(requests[i][0], text, "stop") is None):
+                    results[i] = (text, "stop")
+                    self.metrics.count("cache_hits")
+
+        misses = sorted((i for i, result in enumerate(results) if result is None), key=lambda i: requests[i][0])
+        token_ids = {}
+        with self.metrics.stage("prompt"):
+            for name in dict.fromkeys(requests[i][0] for i in misses):
+                group = [i for i in misses if requests[i][0] == name]
+                _, ids = self.prefix_tokenizers[name]([requests[i][1] for i in group])
+                token_ids.update(zip(group, ids))
+        misses.sort(key=lambda i: (requests[i][0], len(token_ids[i]) // LENGTH_BUCKET))
+
+        start = time.monotonic()
+        with self.metrics.stage("generate"):
+            outputs = self.llm.generate([{"prompt_token_ids": token_ids[i]} for i in misses],
+                                        [self.sampling_params[requests[i][0]] for i in misses],
+                                        use_tqdm=False) if misses else []
+        record_outputs(self.metrics, outputs, time.monotonic() - start)
+        for i, output in zip(misses, outputs):
+            results[i] = (output.outputs[0].text, output.outputs[0].finish_reason)
+            if self.cache is not None and results[i][1] == "stop" \
+                    and (self.validate is None or self.validate(requests[i][0], *results[i]) is None):
+                self.cache.put(keys[i], results[i][0])
+        return results
+
+    def close(self):
+        pass
@@ -0,0 +1,270 @@
+import hashlib
+import json
+import os
+import random
+import time
+from collections import deque
+
+from response_cache import make_key
+
+# OpenAI Batch API limits per input file; the byte limit leaves some headroom below 200 MB
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchJob:
+    """One batch input file: its personas, the current batch and the results collected so far."""
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items              # [(index, persona)] in input order
+        self.results = {}               # custom_id -> synthesized text
+        self.invalid = {}               # custom_id -> (text, reason) of the last response that failed validation
+        self.cached = set()             # custom_ids answered from the response cache
+        self.pending = [str(index) for index, _ in items]
+        self.attempt = 0
+        self.batch_id = None
+        self.status = None
+
+    @property
+    def done(self):
+        return self.status == "done"
+
+
+def iter_request_lines(personas, template, model, temperature, system_prompt, max_tokens=None):
+    for index, persona in personas:
+        request = {
+            "custom_id": str(index),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "temperature": temperature,
+                "messages": [
+                    {"role": "system", "content": f"{system_prompt}"},
+                    {"role": "user", "content": f"{template.format(persona=persona)}"}
+                ]
+            }
+        }
+        if max_tokens:
+            request["body"]["max_tokens"] = max_tokens
+        yield index, persona, (json.dumps(request, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class BatchRunner:
+    """Runs synthesis through the OpenAI Batch API.
+
+    Requests are rendered into batch input files that respect the per-file
+    request and size limits, at most `max_active` batches run at a time, and
+    their status is polled with jittered exponential backoff. Requests that
+    fail inside a batch (or belong to a failed/expired batch) are resubmitted
+    up to `max_attempts` times. Batches are written out in input order, and a
+    manifest in `batch_dir` lets an interrupted run re-attach to batches it
+    already submitted instead of paying for them twice. Usage and finish
+    reasons of the results go to the optional metrics.RunMetrics. Responses
+    for which `validate(text, finish_reason)` returns a reason are treated
+    like failed requests, and handed to `reject_record` if they never pass.
+    """
+
+    def __init__(self, client, batch_dir, model, temperature, system_prompt, max_active=4, max_attempts=3,
+                 max_requests=MAX_REQUESTS_PER_FILE, max_bytes=MAX_BYTES_PER_FILE,
+                 poll_interval=10.0, max_poll_interval=300.0, cache=None, metrics=None, max_tokens=None,
+                 validate=None):
+        self.client = client
+        self.batch_dir = batch_dir
+        self.model = model
+        self.temperature = temperature
+        self.system_prompt = system_prompt
+        self.max_active = max_active
+        self.max_attempts = max_attempts
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.cache = cache
+        self.metrics = metrics
+        self.max_tokens = max_tokens
+        self.validate = validate
+        self.failed = 0
+        self.rejected = 0
+        os.makedirs(batch_dir, exist_ok=True)
+        self.manifest_path = os.path.join(batch_dir, "manifest.json")
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def save_manifest(self):
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def cached_text(self, persona, template):
+        if self.cache is None:
+            return None
+        text = self.cache.get(make_key(self.model, self.temperature, self.system_prompt, template.format(persona=persona)))
+        if text is not None and self.validate is not None and self.validate(text, "stop") is not None:
+            return None
+        return text
+
+    def iter_jobs(self, personas, template):
+        """Split the rendered requests into jobs within the per-file limits; cache hits skip the batch."""
+        items, lines, size, cached = [], [], 0, {}
+        n = 0
+        for index, persona, line in iter_request_lines(personas, template, self.model, self.temperature, self.system_prompt,
+                                                      self.max_tokens):
+            if items and (len(lines) >= self.max_requests or size + len(line) > self.max_bytes):
+                yield self.new_job(f"batch_{n:05d}", items, lines, cached)
+                items, lines, size, cached = [], [], 0, {}
+                n += 1
+            items.append((index, persona))
+            text = self.cached_text(persona, template)
+            if text is not None:
+                cached[str(index)] = text
+                if self.metrics is not None:
+                    self.metrics.count("cache_hits")
+            else:
+                lines.append(line)
+                size += len(line)
+        if items:
+            yield self.new_job(f"batch_{n:05d}", items, lines, cached)
+
+    def new_job(self, name, items, lines, cached):
+        job = BatchJob(name, items)
+        job.results.update(cached)
+        job.cached.update(cached)
+        job.pending = [custom_id for custom_id in job.pending if custom_id not in cached]
+        path = os.path.join(self.batch_dir, f"{name}.jsonl")
+        with open(path, "wb") as f:
+            f.writelines(lines)
+        return job
+
+    def submit(self, job):
+        if not job.pending:
+            job.status = "done"
+            return
+        name = job.name if job.attempt == 0 else f"{job.name}.retry{job.attempt}"
+        path = os.path.join(self.batch_dir, f"{name}.jsonl")
+        if job.attempt > 0:
+            # the retry file holds only the requests that are still missing
+            pending = set(job.pending)
+            with open(os.path.join(self.batch_dir, f"{job.name}.jsonl"), "rb") as src, open(path, "wb") as dst:
+                for line in src:
+                    if json.loads(line)["custom_id"] in pending:
+                        dst.write(line)
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        entry = self.manifest.get(name)
+        if entry and entry["sha256"] == digest:
+            batch = self.client.batches.retrieve(entry["batch_id"])
+            if batch.status not in {"failed", "expired", "cancelled"}:
+                print(f"Re-attached {name} to {batch.id} ({batch.status})")
+                job.batch_id, job.status = batch.id, batch.status
+                return
+
+        with open(path, "rb") as f:
+            input_file = self.client.files.create(file=(os.path.basename(path), f), purpose="batch")
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                           completion_window="24h", metadata={"name": name})
+        self.manifest[name] = {"sha256": digest, "batch_id": batch.id}
+        self.save_manifest()
+        job.batch_id, job.status = batch.id, batch.status
+        print(f"Submitted {name}: {len(job.pending)} requests as {batch.id}")
+
+    def read_file(self, file_id):
+        if file_id is None:
+            return []
+        content = self.client.files.content(file_id).content
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    def collect(self, job, batch):
+        for record in self.read_file(batch.output_file_id) + self.read_file(batch.error_file_id):
+            response = record.get("response") or {}
+            if record.get("error") is None and response.get("status_code") == 200:
+                choice = response["body"]["choices"][0]
+                if self.metrics is not None:
+                    usage = response["body"].get("usage") or {}
+                    # batch requests have no meaningful per-request latency
+                    self.metrics.record_request(None, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0),
+                                                retries=job.attempt, finish_reason=choice.get("finish_reason"))
+                text = choice["message"]["content"]
+                reason = self.validate(text, choice.get("finish_reason")) if self.validate is not None else None
+                if reason is None:
+                    job.results[record["custom_id"]] = text
+                    job.invalid.pop(record["custom_id"], None)
+                else:
+                    job.invalid[record["custom_id"]] = (text, reason)
+        job.pending = [custom_id for custom_id in job.pending if custom_id not in job.results]
+
+    def refresh(self, job):
+        """Poll one job; returns True if its state changed."""
+        batch = self.client.batches.retrieve(job.batch_id)
+        if batch.status not in TERMINAL_STATUSES:
+            changed = batch.status != job.status
+            job.status = batch.status
+            return changed
+
+        # expired or cancelled batches may still carry partial results
+        self.collect(job, batch)
+        job.attempt += 1
+        if job.pending and job.attempt < self.max_attempts:
+            print(f"{job.name}: batch {batch.id} {batch.status}, retrying {len(job.pending)} failed requests")
+            self.submit(job)
+        else:
+            job.status = "done"
+        return True
+
+    def write(self, job, template, write_record, reject_record=None):
+        for index, persona in job.items:
+            text = job.results.get(str(index))
+            if text is None and str(index) in job.invalid and reject_record is not None:
+                self.rejected += 1
+                text, reason = job.invalid[str(index)]
+                reject_record(index, persona, template.format(persona=persona), text, reason=reason)
+                continue
+            if text is None:
+                self.failed += 1
+                if self.metrics is not None:
+                    self.metrics.record_error("batch_request_failed")
+                continue
+            user_prompt = template.format(persona=persona)
+            if self.cache is not None and str(index) not in job.cached:
+                self.cache.put(make_key(self.model, self.temperature, self.system_prompt, user_prompt), text)
+            write_record(index, persona, user_prompt, text)
+
+    def run(self, personas, template, write_record, reject_record=None):
+        jobs = self.iter_jobs(personas, template)
+        active = deque()
+        exhausted = False
+        delay = self.poll_interval
+        while True:
+            while not exhausted and len(active) < self.max_active:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                    break
+                self.submit(job)
+                active.append(job)
+            # finished jobs are written strictly in input order
+            while active and active[0].done:
+                self.write(active.popleft(), template, write_record, reject_record)
+            if not active:
+                if exhausted:
+                    break
+                continue
+
+            changed = False
+            for job in active:
+                if not job.done:
+                    changed = self.refresh(job) or changed
+            if active[0].done:
+                continue
+            delay = self.poll_interval if changed else min(self.max_poll_interval, delay * 1.5)
+            time.sleep(delay * random.uniform(0.8, 1.2))
+        if self.failed:
+            print(f"{self.failed} requests still failed after {self.max_attempts} attempts and were not written")
+        if self.rejected:
+            print(f"{self.rejected} responses were still invalid after {self.max_attempts} attempts and were rejected")
@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import types
+from collections import defaultdict, deque
+
+from prompt_cache import PrefixTokenizer
+from mock_backend import LatencyModel, MockAsyncOpenAI, MockLLM, MockTokenizer
+from persona_source import enumerate_personas
+from prompt_templates import templates, token_budgets, response_headings
+from resume import open_output
+from validation import Validator
+
+STAGES = ["load", "prompt", "backend", "write"]
+
+
+def persona_file(work_dir, n):
+    """Synthetic persona JSONL of n rows, generated once and reused across runs."""
+    path = os.path.join(work_dir, f"personas_{n}.jsonl")
+    if not os.path.exists(path):
+        with open(path + ".tmp", "w") as out:
+            for i in range(n):
+                persona = (f"A {30 + i % 40}-year-old {['nurse', 'historian', 'welder', 'data scientist'][i % 4]} "
+                           f"from city #{i} who enjoys {['chess', 'gardening', 'astronomy'][i % 3]}.")
+                out.write(json.dumps({"persona": persona}) + "\n")
+        os.replace(path + ".tmp", path)
+    return path
+
+
+class StageStats:
+    """CPU seconds per stage (per thread, so the vLLM prep thread is counted correctly) and per-persona latency."""
+
+    def __init__(self):
+        self.cpu = defaultdict(float)
+        self.started = {}                   # persona index -> start time
+        self.indices = defaultdict(deque)   # persona -> indices of its unfinished rows, oldest first
+        self.latencies = []
+
+    def personas(self, items):
+        iterator = iter(items)
+        while True:
+            start = time.thread_time()
+            item = next(iterator, None)
+            self.cpu["load"] += time.thread_time() - start
+            if item is None:
+                return
+            # retried rows finish late and rejected ones never get written, so start times are kept per persona index
+            index, persona = item
+            self.started[index] = time.perf_counter()
+            self.indices[persona].append(index)
+            yield item
+
+    def finish(self, persona):
+        """Pop the start time of the oldest unfinished row of `persona`."""
+        indices = self.indices[persona]
+        index = indices.popleft()
+        if not indices:
+            del self.indices[persona]
+        return self.started.pop(index)
+
+    def template(self, template):
+        stats = self
+
+        class TimedTemplate(str):
+            def format(self, *args, **kwargs):
+                start = time.thread_time()
+                try:
+                    return str.format(self, *args, **kwargs)
+                finally:
+                    stats.cpu["prompt"] += time.thread_time() - start
+
+        return TimedTemplate(template)
+
+
+class TimedPrefixTokenizer:
+    def __init__(self, prefix_tokenizer, stats):
+        self.prefix_tokenizer = prefix_tokenizer
+        self.template = prefix_tokenizer.template
+        self.stats = stats
+
+    def __call__(self, personas):
+        start = time.thread_time()
+        try:
+            return self.prefix_tokenizer(personas)
+        finally:
+            self.stats.cpu["prompt"] += time.thread_time() - start
+
+
+class TimedWriter:
+    def __init__(self, writer, stats):
+        self.writer = writer
+        self.stats = stats
+
+    def write(self, record):
+        self.stats.latencies.append(time.perf_counter() - self.stats.finish(record["input persona"]))
+        start = time.thread_time()
+        self.writer.write(record)
+        self.stats.cpu["write"] += time.thread_time() - start
+
+    def flush(self):
+        start = time.thread_time()
+        self.writer.flush()
+        self.stats.cpu["write"] += time.thread_time() - start
+
+    def close(self):
+        start = time.thread_time()
+        self.writer.close()
+        self.stats.cpu["write"] += time.thread_time() - start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TimedValidator(Validator):
+    """Validator that forgets the start time of rejected personas, which are never written."""
+
+    def __init__(self, max_attempts, stats):
+        super().__init__(max_attempts)
+        self.stats = stats
+
+    def reject(self, template_name, record, reason):
+        self.stats.finish(record["input persona"])
+        super().reject(template_name, record, reason)
+
+
+def percentiles(values, qs=(50, 95, 99)):
+    ordered = sorted(values)
+    if not ordered:
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))] * 1000 for q in qs}
+
+
+def output_bytes(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def latency_model(args):
+    return LatencyModel(args.latency, args.jitter, args.per_token_latency, args.latency_distribution, seed=args.seed)
+
+
+def script_args(args, name, n):
+    # the subset of the synthesize scripts' arguments that their synthesize() functions read
+    return argparse.Namespace(sample_size=n, concurrency=args.concurrency, rpm=0, tpm=0, max_retries=args.max_retries,
+                              num_shards=1, chunk_size=args.chunk_size, template=name, max_tokens=0)
+
+
+def validation_stats(validator):
+    return {"invalid_responses": sum(validator.invalid.values()), "rejected": sum(validator.rejected.values())}
+
+
+def load_script(backend):
+    """Import a synthesize script outside of the timed region."""
+    if backend == "openai":
+        os.environ.setdefault("OPENAI_API_KEY", "mock")  # openai_synthesize creates its clients at import time
+        import openai_synthesize
+        return openai_synthesize
+    # vllm_synthesize imports the code package, so the repository root must be importable
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import vllm_synthesize
+    return vllm_synthesize
+
+
+def run_openai(args, script, name, n, personas, out, stats):
+    client = MockAsyncOpenAI(latency_model(args), args.completion_tokens, args.error_rate, seed=args.seed)
+    validator = TimedValidator(args.invalid_retries + 1, stats)
+    asyncio.run(script.synthesize(stats.personas(personas), stats.template(templates[name]), out,
+                                  script_args(args, name, n), client=client, validator=validator))
+    return {"backend_calls": client.calls, "backend_errors": client.errors, **validation_stats(validator)}, client.cpu_seconds
+
+
+def run_vllm(args, script, name, n, personas, out, stats, tokenizer):
+    render = lambda user_prompt: script.request_input_format(user_prompt, tokenizer)
+    prefix_tokenizer = PrefixTokenizer(tokenizer, templates[name], render, enabled=not args.disable_prefix_cache)
+    llm = MockLLM(latency_model(args), args.completion_tokens, args.length_rate, seed=args.seed,
+                  heading=response_headings.get(name, ""))
+    sampling_params = types.SimpleNamespace(temperature=0.6, top_p=0.95, max_tokens=token_budgets.get(name, 2048),
+                                            stop=["<|eot_id|>"])
+    chunks = script.iter_chunks(stats.personas(personas), args.chunk_size)
+    validator = TimedValidator(args.invalid_retries + 1, stats)
+    script.synthesize(llm, TimedPrefixTokenizer(prefix_tokenizer, stats), sampling_params, chunks, out,
+                      script_args(args, name, n), validator=validator)
+    return {"backend_calls": llm.calls, **validation_stats(validator)}, llm.cpu_seconds
+
+
+def worker(args):
+    backend, name, n = args.worker.split(":")
+    n = int(n)
+    personas_path = args.dataset or persona_file(args.work_dir, n)
+    suffix = "parquet" if args.output_format == "parquet" else "jsonl"
+    output_path = os.path.join(args.work_dir, f"out_{backend}_{name}_{n}.{suffix}")
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+
+    script = load_script(backend)
+    if backend == "vllm" and args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    else:
+        tokenizer = MockTokenizer()
+
+    stats = StageStats()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    personas = enumerate_personas(personas_path, None, limit=n)
+    writer, _ = open_output(output_path, name, False, args.output_format)
+    with TimedWriter(writer, stats) as out:
+        if backend == "openai":
+            extra, backend_cpu = run_openai(args, script, name, n, personas, out, stats)
+        else:
+            extra, backend_cpu = run_vllm(args, script, name, n, personas, out, stats, tokenizer)
+    wall = time.perf_counter() - wall_start
+    cpu_total = time.process_time() - cpu_start
+    stats.cpu["backend"] = backend_cpu
+
+    cpu = {stage: stats.cpu[stage] for stage in STAGES}
+    cpu["other"] = max(0.0, cpu_total - sum(cpu.values()))
+    cpu["total"] = cpu_total
+    result = {
+        "backend": backend,
+        "template": name,
+        "num_personas": len(stats.latencies),
+        "wall_seconds": wall,
+        "personas_per_sec": len(stats.latencies) / wall,
+        "latency_ms": percentiles(stats.latencies),
+        "cpu_seconds": cpu,
+        "cpu_us_per_persona": {stage: seconds / max(1, len(stats.latencies)) * 1e6 for stage, seconds in cpu.items()},
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024),
+        "output_bytes": output_bytes(output_path),
+        **extra,
+    }
+    if not args.keep_outputs:
+        if os.path.isdir(output_path):
+            shutil.rmtree(output_path)
+        else:
+            os.remove(output_path)
+    print("BENCH_RESULT " + json.dumps(result))
+
+
+def run_worker(spec):
+    # every run gets a fresh process so peak RSS and import costs are not shared between runs
+    command = [sys.executable, os.path.abspath(__file__)] + sys.argv[1:] + ["--worker", spec]
+    proc = subprocess.run(command, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Benchmark run {spec} failed:\n{proc.stderr[-4000:]}")
+    line = [l for l in proc.stdout.splitlines() if l.startswith("BENCH_RESULT ")][-1]
+    return json.loads(line[len("BENCH_RESULT "):])
+
+
+def compare(runs, baseline_path, tolerance):
+    with open(baseline_path) as f:
+        baseline = {(r["backend"], r["template"], r["num_personas"]): r for r in json.load(f)["runs"]}
+    regressions = []
+    for r in runs:
+        old = baseline.get((r["backend"], r["template"], r["num_personas"]))
+        if old is None:
+            continue
+        change = r["personas_per_sec"] / old["personas_per_sec"] - 1
+        r["change_vs_baseline"] = change
+        if change < -tolerance:
+            regressions.append(r)
+        print(f"{r['backend']:>7} {r['template']:>12} {r['num_personas']:>9}: {old['personas_per_sec']:>10.0f} -> "
+              f"{r['personas_per_sec']:>10.0f} personas/s ({change:+.1%}){'  REGRESSION' if change < -tolerance else ''}")
+    return regressions
+
+
+def main(args):
+    os.makedirs(args.work_dir, exist_ok=True)
+    print(f"{'backend':>7} {'template':>12} {'personas':>9} {'per sec':>10} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'load':>6} {'prompt':>6} {'backend':>7} {'write':>6} {'other':>6} {'RSS MB':>7}   (CPU us/persona)")
+    runs = []
+    for n in args.sizes:
+        for backend in args.backends:
+            for name in args.templates:
+                r = run_worker(f"{backend}:{name}:{n}")
+                runs.append(r)
+                us = r["cpu_us_per_persona"]
+                print(f"{backend:>7} {name:>12} {r['num_personas']:>9} {r['personas_per_sec']:>10.0f} "
+                      f"{r['latency_ms']['p50']:>8.1f} {r['latency_ms']['p99']:>8.1f} {us['load']:>6.1f} {us['prompt']:>6.1f} "
+                      f"{us['backend']:>7.1f} {us['write']:>6.1f} {us['other']:>6.1f} {r['peak_rss_mb']:>7.0f}")
+
+    regressions = compare(runs, args.baseline, args.tolerance) if args.baseline else []
+    if args.output_path:
+        config = {k: v for k, v in vars(args).items() if k not in ("worker", "output_path", "baseline")}
+        results = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                   "machine": platform.machine(), "cpu_count": os.cpu_count(), "config": config, "runs": runs}
+        with open(args.output_path, "w") as out:
+            json.dump(results, out, indent=2)
+        print(f"Outputted the results to: {args.output_path}")
+    if regressions:
+        print(f"{len(regressions)} runs are more than {args.tolerance:.0%} slower than {args.baseline}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the throughput of the synthesis pipeline itself against an in-process mock LLM.")
+    parser.add_argument('--backends', type=str, nargs='+', default=["openai", "vllm"], choices=["openai", "vllm"])
+    parser.add_argument('--templates', type=str, nargs='+', default=list(templates), choices=list(templates))
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000], help='Numbers of personas to run.')
+    parser.add_argument('--dataset', type=str, default="", help='Local .jsonl/.parquet personas to use instead of generated ones.')
+    parser.add_argument('--work_dir', type=str, default="bench_pipeline", help='Where generated personas and outputs are kept.')
+    parser.add_argument('--output_format', type=str, default="jsonl", choices=["jsonl", "parquet"])
+    parser.add_argument('--keep_outputs', action='store_true')
+    parser.add_argument('--latency', type=float, default=0.0, help='Base latency in seconds of a request (openai) or a generate call (vllm).')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Standard deviation (normal) or shape (lognormal) of the latency.')
+    parser.add_argument('--per_token_latency', type=float, default=0.0, help='Extra seconds per completion token.')
+    parser.add_argument('--latency_distribution', type=str, default="lognormal", choices=["fixed", "normal", "lognormal"])
+    parser.add_argument('--completion_tokens', type=int, default=64, help='Number of tokens in every mock completion.')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of openai requests answered with a rate-limit error.')
+    parser.add_argument('--length_rate', type=float, default=0.0, help='Fraction of vllm outputs that finish with "length".')
+    parser.add_argument('--concurrency', type=int, default=256, help='Requests in flight for the openai path.')
+    parser.add_argument('--max_retries', type=int, default=8)
+    parser.add_argument('--invalid_retries', type=int, default=2, help='Times an invalid response (e.g. --length_rate ones) is generated again.')
+    parser.add_argument('--chunk_size', type=int, default=4096, help='Personas per generate call for the vllm path.')
+    parser.add_argument('--tokenizer', type=str, default="", help='Hugging Face tokenizer for the vllm path; a byte-level mock by default.')
+    parser.add_argument('--disable_prefix_cache', action='store_true', help='Render and tokenize every vllm prompt in full.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output_path', type=str, default="", help='Write the results as JSON to this path.')
+    parser.add_argument('--baseline', type=str, default="", help='Results JSON of an earlier run to compare personas/sec against.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Slowdown against the baseline that counts as a regression.')
+    parser.add_argument('--worker', type=str, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        worker(args)
+    else:
+        main(args)
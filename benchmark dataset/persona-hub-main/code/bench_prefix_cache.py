@@ -0,0 +1,116 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from transformers import AutoTokenizer
+from prompt_cache import PrefixTokenizer
+from prompt_templates import templates
+
+
+def make_render(tokenizer):
+    # same chat format as vllm_synthesize.request_input_format
+    def render(user_prompt):
+        messages = [{"role": "system", "content": "You are a helpful assistant."}, {"role": "user", "content": user_prompt}]
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return render
+
+
+def load_personas(args):
+    if args.dataset:
+        from persona_source import iter_personas
+        return list(iter_personas(args.dataset, args.data_files, limit=args.num_personas))
+    return [f"A {30 + i % 40}-year-old {['nurse', 'historian', 'welder', 'data scientist'][i % 4]} from city #{i} "
+            f"who enjoys {['chess', 'gardening', 'astronomy'][i % 3]}." for i in range(args.num_personas)]
+
+
+def time_prep(fn, personas, chunk_size):
+    start = time.perf_counter()
+    token_ids = []
+    for i in range(0, len(personas), chunk_size):
+        token_ids.extend(fn(personas[i:i + chunk_size])[1])
+    return time.perf_counter() - start, token_ids
+
+
+def prefill_worker(args):
+    from vllm import LLM, SamplingParams
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    personas = load_personas(args)
+    llm = LLM(model=args.model_path, tensor_parallel_size=args.tensor_parallel_size,
+              enable_prefix_caching=args.prefill_worker == "on")
+    # max_tokens=1 makes the generate call dominated by prefill
+    sampling_params = SamplingParams(temperature=0.0, max_tokens=1)
+    results = {}
+    for name in args.templates:
+        _, token_ids = PrefixTokenizer(tokenizer, templates[name], make_render(tokenizer))(personas)
+        prompts = [{"prompt_token_ids": ids} for ids in token_ids]
+        llm.generate(prompts[:1], sampling_params, use_tqdm=False)
+        start = time.perf_counter()
+        llm.generate(prompts, sampling_params, use_tqdm=False)
+        results[name] = time.perf_counter() - start
+    print("PREFILL_RESULT " + json.dumps(results))
+
+
+def run_prefill(args, setting):
+    command = [sys.executable, __file__, "--prefill_worker", setting] + sys.argv[1:]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    line = [l for l in output.splitlines() if l.startswith("PREFILL_RESULT ")][-1]
+    return json.loads(line[len("PREFILL_RESULT "):])
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path)
+    render = make_render(tokenizer)
+    personas = load_personas(args)
+    print(f"Benchmarking prompt preparation for {len(personas)} personas with the {args.model_path} tokenizer")
+
+    results = {}
+    for name in args.templates:
+        full = PrefixTokenizer(tokenizer, templates[name], render, enabled=False)
+        cached = PrefixTokenizer(tokenizer, templates[name], render)
+        full_time, full_ids = time_prep(full, personas, args.chunk_size)
+        cached_time, cached_ids = time_prep(cached, personas, args.chunk_size)
+        results[name] = {
+            "prefix_tokens": len(cached.prefix_ids) if cached.enabled else 0,
+            "mean_prompt_tokens": sum(len(ids) for ids in full_ids) / len(full_ids),
+            "full_prep_seconds": full_time,
+            "cached_prep_seconds": cached_time,
+            "prep_speedup": full_time / cached_time,
+            "token_ids_identical": [list(ids) for ids in full_ids] == cached_ids,
+        }
+        r = results[name]
+        print(f"{name:>12}: prefix {r['prefix_tokens']:>5} of {r['mean_prompt_tokens']:>7.1f} tokens, "
+              f"prep {full_time:.3f}s -> {cached_time:.3f}s ({r['prep_speedup']:.1f}x), identical={r['token_ids_identical']}")
+
+    if args.prefill:
+        off, on = run_prefill(args, "off"), run_prefill(args, "on")
+        for name in args.templates:
+            results[name].update({"prefill_seconds": off[name], "prefill_seconds_prefix_cached": on[name],
+                                  "prefill_speedup": off[name] / on[name]})
+            print(f"{name:>12}: prefill {off[name]:.2f}s -> {on[name]:.2f}s ({off[name] / on[name]:.1f}x) with prefix caching")
+
+    if args.output_path:
+        with open(args.output_path, "w") as out:
+            json.dump(results, out, indent=2)
+        print(f"Outputted the results to: {args.output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure prompt preparation and prefill time saved by prefix caching.")
+    parser.add_argument('--model_path', type=str, default="meta-llama/Meta-Llama-3-70B-Instruct", help='Model (or tokenizer) path.')
+    parser.add_argument('--templates', type=str, nargs='+', default=list(templates), choices=list(templates))
+    parser.add_argument('--num_personas', type=int, default=10000)
+    parser.add_argument('--dataset', type=str, default="", help='Read personas from this dataset instead of generating synthetic ones.')
+    parser.add_argument('--data_files', type=str, default="persona.jsonl")
+    parser.add_argument('--chunk_size', type=int, default=4096)
+    parser.add_argument('--prefill', action='store_true', help='Also time vLLM prefill with and without prefix caching (needs GPUs).')
+    parser.add_argument('--tensor_parallel_size', type=int, default=4)
+    parser.add_argument('--output_path', type=str, default="", help='Optional path to write the results as JSON.')
+    parser.add_argument('--prefill_worker', type=str, choices=['on', 'off'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.prefill_worker:
+        prefill_worker(args)
+    else:
+        main(args)
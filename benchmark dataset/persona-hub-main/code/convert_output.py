@@ -0,0 +1,31 @@
+import argparse
+import json
+import os
+
+from output_writers import ParquetWriter
+
+
+def convert(input_path, output_path, template_name="", row_group_size=10000):
+    if os.path.isdir(output_path) and os.listdir(output_path):
+        raise FileExistsError(f"{output_path} is not empty.")
+    n = 0
+    with open(input_path, "rb") as f, ParquetWriter(output_path, template_name, row_group_size=row_group_size) as writer:
+        for line in f:
+            if not line.endswith(b"\n"):
+                # a record cut off by a crash
+                break
+            writer.write(json.loads(line))
+            n += 1
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a JSONL output of a synthesize script to a Parquet output directory.")
+    parser.add_argument('--input_path', type=str, required=True, help='JSONL output file.')
+    parser.add_argument('--output_path', type=str, required=True, help='Directory to write the Parquet parts to.')
+    parser.add_argument('--template', type=str, default="", help='Template the file was generated with; stored in the Parquet metadata.')
+    parser.add_argument('--row_group_size', type=int, default=10000)
+    args = parser.parse_args()
+
+    n = convert(args.input_path, args.output_path, args.template, args.row_group_size)
+    print(f"Converted {n} records into: {args.output_path}")
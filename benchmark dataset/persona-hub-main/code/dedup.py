@@ -0,0 +1,303 @@
+import argparse
+import io
+import json
+import os
+import re
+
+import numpy as np
+
+EMPTY = np.uint64(0)
+WHITESPACE = re.compile(r"\s+")
+
+
+def _mix64(h):
+    # murmur3 finalizer; spreads polynomial shingle hashes over all 64 bits
+    h = h ^ (h >> np.uint64(33))
+    h = h * np.uint64(0xff51afd7ed558ccd)
+    h = h ^ (h >> np.uint64(33))
+    h = h * np.uint64(0xc4ceb9fe1a85ec53)
+    return h ^ (h >> np.uint64(33))
+
+
+def shingles(texts, ngram=5):
+    """Return the hashes of all character n-grams of the texts and the offset of each text's first n-gram.
+
+    Texts are lowercased and their whitespace collapsed first; texts shorter
+    than `ngram` are padded so that each one has at least one n-gram.
+    """
+    powers = np.uint64(1099511628211) ** np.arange(ngram - 1, -1, -1, dtype=np.uint64)
+    docs = [WHITESPACE.sub(" ", text.lower()).strip().encode("utf-8").ljust(ngram) for text in texts]
+    lengths = np.array([len(doc) for doc in docs], dtype=np.int64)
+    data = np.frombuffer(b"".join(docs), dtype=np.uint8).astype(np.uint64)
+    span = len(data) - ngram + 1
+    h = np.zeros(span, dtype=np.uint64)
+    for k in range(ngram):
+        h += data[k:k + span] * powers[k]
+    # keep only n-grams that do not cross from one text into the next
+    counts = lengths - ngram + 1
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    doc_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    valid = np.arange(counts.sum()) + np.repeat(doc_starts - offsets, counts)
+    return _mix64(h[valid]), offsets
+
+
+class MinHasher:
+    """Vectorized MinHash over character n-grams.
+
+    The texts of a batch are concatenated into one byte array, every n-gram of
+    the batch is hashed at once and the per-text minima are taken with
+    np.minimum.reduceat, so there is no per-shingle Python work.
+    """
+
+    def __init__(self, num_perm=128, ngram=5, seed=1, perm_block=32):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.ngram = ngram
+        self.perm_block = perm_block
+        # multiply-shift hash family: ((a * x + b) mod 2^64) >> 32 with odd a
+        self.a = (rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1))[:, None]
+        self.b = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)[:, None]
+
+    def signatures(self, texts):
+        hashes, offsets = shingles(texts, self.ngram)
+        signatures = np.empty((self.num_perm, len(texts)), dtype=np.uint32)
+        # permutations are processed in blocks to bound the size of the hashed matrix
+        hashed = np.empty((self.perm_block, len(hashes)), dtype=np.uint64)
+        for start in range(0, self.num_perm, self.perm_block):
+            block = slice(start, start + self.perm_block)
+            out = hashed[:len(self.a[block])]
+            np.multiply(self.a[block], hashes, out=out)
+            out += self.b[block]
+            out >>= np.uint64(32)
+            signatures[block] = np.minimum.reduceat(out, offsets, axis=1)
+        return signatures.T
+
+
+class BandTable:
+    """Open-addressing hash table from band key to the first row id seen with it.
+
+    Arrays live in memory, or in np.memmap files under `index_dir` so the index
+    for hundreds of millions of rows is bounded by disk rather than RAM.
+    """
+
+    def __init__(self, capacity, index_dir=None, name="band"):
+        self.index_dir = index_dir
+        self.name = name
+        self.size = 0
+        self.generation = 0
+        self._allocate(capacity)
+
+    def _array(self, suffix, dtype):
+        if self.index_dir is None:
+            return np.zeros(self.capacity, dtype=dtype)
+        path = os.path.join(self.index_dir, f"{self.name}.{self.generation}.{suffix}")
+        return np.memmap(path, dtype=dtype, mode="w+", shape=(self.capacity,))
+
+    def _allocate(self, capacity):
+        self.capacity = 1 << max(4, int(capacity - 1).bit_length())
+        self.mask = np.uint64(self.capacity - 1)
+        self.keys = self._array("keys", np.uint64)
+        self.values = self._array("values", np.int64)
+
+    def _grow(self, needed):
+        old_keys, old_values = self.keys, self.values
+        old_files = [old_keys.filename, old_values.filename] if self.index_dir is not None else []
+        used = old_keys != EMPTY
+        self.generation += 1
+        capacity = self.capacity * 2
+        while needed * 10 > capacity * 7:
+            capacity *= 2
+        self._allocate(capacity)
+        self.size = 0
+        self.lookup_or_insert(old_keys[used], old_values[used])
+        del old_keys, old_values, used
+        for path in old_files:
+            os.remove(path)
+
+    def lookup_or_insert(self, keys, ids):
+        """For every key return the id first stored under it, inserting `ids` for new keys.
+
+        Keys within the batch are deduplicated first (the earliest id wins), then
+        all remaining keys probe the table in lock-step with linear probing.
+        """
+        if (self.size + len(keys)) * 10 > self.capacity * 7:
+            self._grow(self.size + len(keys))
+        unique_keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        result = ids[first].copy()
+        slots = _mix64(unique_keys) & self.mask
+        active = np.arange(len(unique_keys))
+        while len(active):
+            slot = slots[active]
+            stored = self.keys[slot]
+            found = stored == unique_keys[active]
+            result[active[found]] = self.values[slot[found]]
+
+            empty = np.flatnonzero(stored == EMPTY)
+            # several keys may race for the same empty slot; the first one gets it
+            _, winners = np.unique(slot[empty], return_index=True)
+            winners = empty[winners]
+            self.keys[slot[winners]] = unique_keys[active[winners]]
+            self.values[slot[winners]] = result[active[winners]]
+            self.size += len(winners)
+
+            settled = found.copy()
+            settled[winners] = True
+            active = active[~settled]
+            slots[active] = (slots[active] + np.uint64(1)) & self.mask
+        return result[inverse]
+
+
+class NearDuplicateIndex:
+    """Streaming MinHash/LSH near-duplicate detector.
+
+    Signatures are split into `bands` bands; two texts become a duplicate pair
+    when any band matches exactly, which happens with high probability above a
+    Jaccard similarity of about (1 / bands) ** (1 / rows). Only band keys are
+    kept, never the texts themselves; the (duplicate, match) id pairs are
+    appended to a file (under `index_dir`, or in memory) as they are found
+    and only grouped into clusters by clusters().
+    """
+
+    def __init__(self, num_perm=128, bands=16, ngram=5, capacity=1 << 20, index_dir=None, seed=1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be divisible by bands ({bands}).")
+        if index_dir is not None:
+            os.makedirs(index_dir, exist_ok=True)
+        self.hasher = MinHasher(num_perm=num_perm, ngram=ngram, seed=seed)
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.tables = [BandTable(capacity, index_dir, name=f"band{b:03d}") for b in range(bands)]
+        self.row_mix = np.random.default_rng(seed + 1).integers(1, 2 ** 63, size=self.rows, dtype=np.uint64) | np.uint64(1)
+        self.pairs = open(os.path.join(index_dir, "pairs.i64"), "w+b") if index_dir is not None else io.BytesIO()
+
+    @property
+    def threshold(self):
+        return (1 / self.bands) ** (1 / self.rows)
+
+    def band_keys(self, signatures):
+        banded = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        keys = _mix64((banded * self.row_mix).sum(axis=2))
+        # 0 marks an empty slot in the band tables
+        return np.where(keys == EMPTY, np.uint64(1), keys)
+
+    def add_batch(self, texts, ids):
+        """Index a batch and return, per text, the id of the earlier text it duplicates or -1."""
+        ids = np.asarray(ids, dtype=np.int64)
+        keys = self.band_keys(self.hasher.signatures(texts))
+        matches = np.stack([table.lookup_or_insert(keys[:, b], ids) for b, table in enumerate(self.tables)], axis=1)
+        matches = np.where(matches == ids[:, None], np.iinfo(np.int64).max, matches).min(axis=1)
+        duplicate = matches != np.iinfo(np.int64).max
+        self.pairs.write(np.stack([ids[duplicate], matches[duplicate]], axis=1).tobytes())
+        return np.where(duplicate, matches, -1).tolist()
+
+    def clusters(self):
+        """Yield (representative id, sorted duplicate ids) for every cluster, ordered by representative.
+
+        A duplicate may match another duplicate, so every match is followed
+        back to the first text of its cluster with vectorized lookups.
+        """
+        self.pairs.flush()
+        self.pairs.seek(0)
+        pairs = np.frombuffer(self.pairs.read(), dtype=np.int64).reshape(-1, 2)
+        self.pairs.seek(0, io.SEEK_END)
+        order = np.argsort(pairs[:, 0], kind="stable")
+        duplicates, matches = pairs[order, 0], pairs[order, 1]
+        roots = matches.copy()
+        while len(roots):
+            position = np.minimum(np.searchsorted(duplicates, roots), len(duplicates) - 1)
+            found = duplicates[position] == roots
+            if not found.any():
+                break
+            roots[found] = matches[position[found]]
+        order = np.argsort(roots, kind="stable")
+        roots, duplicates = roots[order], duplicates[order]
+        starts = np.flatnonzero(np.diff(roots, prepend=-1)) if len(roots) else []
+        for start, end in zip(starts, list(starts[1:]) + [len(roots)]):
+            yield int(roots[start]), duplicates[start:end].tolist()
+
+
+def filter_near_duplicates(items, index, text=lambda item: item[1], batch_size=1024, on_duplicate=None):
+    """Lazily drop items whose text is a near-duplicate of an earlier one.
+
+    `items` are (id, ...) tuples such as the (index, persona) pairs from
+    persona_source.enumerate_personas; `on_duplicate(item, representative_id)`
+    is called for every dropped item.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield from _filter_batch(batch, index, text, on_duplicate)
+            batch = []
+    if batch:
+        yield from _filter_batch(batch, index, text, on_duplicate)
+
+
+def _filter_batch(batch, index, text, on_duplicate):
+    matches = index.add_batch([text(item) for item in batch], [item[0] for item in batch])
+    for item, match in zip(batch, matches):
+        if match < 0:
+            yield item
+        elif on_duplicate is not None:
+            on_duplicate(item, match)
+
+
+def write_clusters(index, path):
+    with open(path, "w") as out:
+        for root, members in index.clusters():
+            out.write(json.dumps({"representative": root, "duplicates": members}) + "\n")
+
+
+def dedup_personas(personas, clusters_path, **kwargs):
+    """Pipeline stage for the synthesize scripts: filter (index, persona) pairs and report clusters at the end."""
+    index = NearDuplicateIndex(**kwargs)
+    dropped = 0
+
+    def count(item, match):
+        nonlocal dropped
+        dropped += 1
+
+    yield from filter_near_duplicates(personas, index, on_duplicate=count)
+    write_clusters(index, clusters_path)
+    print(f"Dropped {dropped} near-duplicate personas; clusters written to: {clusters_path}")
+
+
+def main(args):
+    index = NearDuplicateIndex(num_perm=args.num_perm, bands=args.bands, ngram=args.ngram,
+                               capacity=args.capacity, index_dir=args.index_dir or None)
+    print(f"LSH with {index.bands} bands x {index.rows} rows; estimated Jaccard threshold {index.threshold:.2f}")
+
+    def records():
+        with open(args.input_path, "rb") as f:
+            for i, line in enumerate(f):
+                yield i, line
+
+    kept = dropped = 0
+    with open(args.output_path, "wb") as out, open(args.clusters_path + ".pairs.jsonl", "w") as pairs:
+        def report(item, match):
+            nonlocal dropped
+            dropped += 1
+            pairs.write(json.dumps({"line": item[0], "duplicate_of_line": match}) + "\n")
+
+        text = lambda item: json.loads(item[1])[args.field]
+        for _, line in filter_near_duplicates(records(), index, text=text, batch_size=args.batch_size, on_duplicate=report):
+            out.write(line)
+            kept += 1
+    write_clusters(index, args.clusters_path)
+    print(f"Kept {kept} records, dropped {dropped} near-duplicates; clusters written to: {args.clusters_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drop near-duplicate records from a JSONL file with MinHash/LSH.")
+    parser.add_argument('--input_path', type=str, required=True, help='JSONL file, e.g. the output of a synthesize script.')
+    parser.add_argument('--output_path', type=str, required=True, help='Where to write the records that are kept.')
+    parser.add_argument('--clusters_path', type=str, required=True, help='Where to write the duplicate clusters (line numbers).')
+    parser.add_argument('--field', type=str, default="synthesized text", help='Field to compare, e.g. "synthesized text" or "input persona".')
+    parser.add_argument('--num_perm', type=int, default=128, help='Number of MinHash permutations.')
+    parser.add_argument('--bands', type=int, default=16, help='Number of LSH bands; more bands lower the similarity threshold.')
+    parser.add_argument('--ngram', type=int, default=5, help='Character n-gram size of the shingles.')
+    parser.add_argument('--batch_size', type=int, default=1024)
+    parser.add_argument('--capacity', type=int, default=1 << 20, help='Initial number of slots per band table; grows as needed.')
+    parser.add_argument('--index_dir', type=str, default="", help='Keep the band tables in memory-mapped files in this directory.')
+    args = parser.parse_args()
+    main(args)
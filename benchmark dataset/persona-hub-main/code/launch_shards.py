@@ -0,0 +1,73 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from sharding import shard_path
+
+scripts = {
+    "openai": os.path.join(os.path.dirname(os.path.abspath(__file__)), "openai_synthesize.py"),
+    "vllm": os.path.join(os.path.dirname(os.path.abspath(__file__)), "vllm_synthesize.py"),
+}
+
+
+def worker_env(args, worker):
+    env = dict(os.environ)
+    # vllm_synthesize imports the code package, so the repository root must be importable
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(p for p in [root, env.get("PYTHONPATH", "")] if p)
+    if args.backend == "vllm":
+        first_gpu = worker * args.gpus_per_replica
+        env["CUDA_VISIBLE_DEVICES"] = ",".join(str(first_gpu + g) for g in range(args.gpus_per_replica))
+    return env
+
+
+def main(args, script_args):
+    num_shards = args.num_shards or args.num_workers
+    shards = list(range(args.first_shard, min(args.first_shard + args.num_workers, num_shards)))
+    if not shards:
+        raise ValueError(f"No shards to run: --first_shard {args.first_shard} is beyond --num_shards {num_shards}.")
+
+    procs = {}
+    for worker, shard in enumerate(shards):
+        command = [sys.executable, scripts[args.backend], *script_args,
+                   "--num_shards", str(num_shards), "--shard_index", str(shard),
+                   "--output_path", shard_path(args.output_path, shard, num_shards)]
+        if args.backend == "vllm":
+            command += ["--tensor_parallel_size", str(args.gpus_per_replica)]
+        log = open(shard_path(args.output_path, shard, num_shards) + ".log", "a")
+        procs[shard] = (subprocess.Popen(command, env=worker_env(args, worker), stdout=log, stderr=subprocess.STDOUT), log)
+        print(f"Started shard {shard} of {num_shards} (pid {procs[shard][0].pid})")
+
+    start = time.time()
+    failed = []
+    for shard, (proc, log) in procs.items():
+        code = proc.wait()
+        log.close()
+        if code != 0:
+            failed.append(shard)
+        print(f"Shard {shard} finished with exit code {code} after {time.time() - start:.0f}s")
+
+    if failed:
+        print(f"Failed shards: {failed}. Re-run them with --resume; see the .log files next to the outputs.")
+        sys.exit(1)
+    if args.merge:
+        from merge_shards import merge
+        n = merge([shard_path(args.output_path, shard, num_shards) for shard in range(num_shards)], args.output_path)
+        print(f"Merged {n} records into: {args.output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run several shards of a synthesize script concurrently. Arguments not listed here "
+                    "(e.g. --template, --model_path, --resume) are passed through to the script.")
+    parser.add_argument('--backend', type=str, required=True, choices=list(scripts))
+    parser.add_argument('--num_workers', type=int, required=True, help='Number of shards to run concurrently on this machine.')
+    parser.add_argument('--num_shards', type=int, default=0, help='Total number of shards across all machines; defaults to --num_workers.')
+    parser.add_argument('--first_shard', type=int, default=0, help='First shard run on this machine, e.g. node_rank * num_workers.')
+    parser.add_argument('--gpus_per_replica', type=int, default=1, help='GPUs given to each vLLM replica (its tensor_parallel_size).')
+    parser.add_argument('--output_path', type=str, required=True, help='Base output path; shard i writes to <base>.shardXXXXX-of-YYYYY.jsonl.')
+    parser.add_argument('--merge', action='store_true', help='Merge all shard outputs into --output_path once every shard has finished.')
+    args, script_args = parser.parse_known_args()
+    main(args, script_args)
@@ -0,0 +1,67 @@
+import argparse
+import glob
+import heapq
+import re
+
+import numpy as np
+
+INDEX_FIELD = re.compile(rb'"persona_index": (\d+)')
+
+
+def _index_records(path):
+    """Return the persona_index and byte offset of every complete record in a shard."""
+    indices, offsets = [], []
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                # a record cut off by a crash; the shard needs to be resumed first
+                break
+            match = INDEX_FIELD.search(line)
+            if match is None:
+                raise ValueError(f"{path} has a record without persona_index; was it written with --num_shards > 1?")
+            indices.append(int(match.group(1)))
+            offsets.append(offset)
+            offset += len(line)
+    return np.array(indices, dtype=np.int64), np.array(offsets, dtype=np.int64)
+
+
+def read_shard(path):
+    """Yield the (persona_index, line) records of a shard in persona_index order.
+
+    Shards are written in input order, except that a --resume run appends the
+    personas it retries (rejected responses, failed batch requests) at the
+    end. Such a shard is read in sorted order by seeking to each record, so
+    only its indices and offsets are held in memory.
+    """
+    indices, offsets = _index_records(path)
+    with open(path, "rb") as f:
+        if np.all(indices[1:] >= indices[:-1]):
+            for index in indices.tolist():
+                yield index, f.readline()
+            return
+        order = np.argsort(indices, kind="stable")
+        for index, offset in zip(indices[order].tolist(), offsets[order].tolist()):
+            f.seek(offset)
+            yield index, f.readline()
+
+
+def merge(paths, output_path):
+    """Streaming k-way merge of shard outputs back into the original persona order."""
+    n = 0
+    with open(output_path, "wb") as out:
+        for _, line in heapq.merge(*[read_shard(path) for path in paths], key=lambda item: item[0]):
+            out.write(line)
+            n += 1
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge shard outputs into one JSONL file in the original persona order.")
+    parser.add_argument('--inputs', type=str, nargs='+', required=True, help='Shard output files or globs, e.g. "out.shard*-of-00008.jsonl".')
+    parser.add_argument('--output_path', type=str, required=True, help='Path to the merged output file.')
+    args = parser.parse_args()
+
+    paths = sorted(path for pattern in args.inputs for path in (glob.glob(pattern) or [pattern]))
+    n = merge(paths, args.output_path)
+    print(f"Merged {n} records from {len(paths)} shards into: {args.output_path}")
@@ -0,0 +1,242 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, float("inf"))
+PREFIX = "personahub"
+_DONE = object()
+
+
+def _labels(labels, **extra):
+    items = {**labels, **extra}
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in sorted(items.items())) + "}"
+
+
+class RunMetrics:
+    """Per-request and per-stage metrics of a synthesis run.
+
+    Requests are recorded with their latency, prompt/completion tokens,
+    retries, time spent waiting for the rate limiter or in backoff, and
+    finish reason. Throughput and tokens/sec are also kept over a rolling
+    `window` of seconds. With a `path`, the metrics are written every
+    `interval` seconds to `<path>.prom` (Prometheus textfile collector
+    format) and `<path>.json`. `stage(name)` times a block of pipeline code;
+    with a `profile_dir`, each stage also runs under its own cProfile
+    profiler, dumped to `<profile_dir>/<stage>.prof` at close(). Without one
+    the hook adds no frames, so py-spy stacks look as they would without it.
+    """
+
+    def __init__(self, labels=None, path="", interval=30.0, window=60.0, profile_dir="", max_latencies=100000):
+        self.labels = labels or {}
+        self.path = path
+        self.interval = interval
+        self.window = window
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.next_export = time.monotonic() + interval
+
+        self.counters = Counter()
+        self.finish_reasons = Counter()
+        self.errors = Counter()
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.latencies = deque(maxlen=max_latencies)
+        self.recent = deque()          # (monotonic time, completion tokens) of recent requests
+        self.recent_records = deque()  # monotonic times of recently written records
+        self.stage_wall = defaultdict(float)
+        self.stage_cpu = defaultdict(float)
+        self.stage_calls = Counter()
+        self.profilers = {}
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def record_request(self, latency=None, prompt_tokens=0, completion_tokens=0, retries=0, finish_reason=None,
+                       wait=0.0, backoff=0.0):
+        now = time.monotonic()
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["prompt_tokens"] += prompt_tokens
+            self.counters["completion_tokens"] += completion_tokens
+            self.counters["retries"] += retries
+            self.counters["rate_limit_wait_seconds"] += wait
+            self.counters["backoff_seconds"] += backoff
+            if finish_reason is not None:
+                self.finish_reasons[finish_reason] += 1
+            if latency is not None:
+                self.latency_sum += latency
+                self.latencies.append(latency)
+                for i, bound in enumerate(LATENCY_BUCKETS):
+                    if latency <= bound:
+                        self.buckets[i] += 1
+                        break
+            self.recent.append((now, completion_tokens))
+            self._prune(now)
+        self.maybe_export()
+
+    def record_error(self, kind):
+        with self.lock:
+            self.errors[kind] += 1
+
+    def count(self, name, n=1):
+        now = time.monotonic()
+        with self.lock:
+            self.counters[name] += n
+            if name == "records":
+                self.recent_records.extend([now] * n)
+                self._prune(now)
+        if name == "records":
+            self.maybe_export()
+
+    def _prune(self, now):
+        while self.recent and self.recent[0][0] < now - self.window:
+            self.recent.popleft()
+        while self.recent_records and self.recent_records[0] < now - self.window:
+            self.recent_records.popleft()
+
+    @contextmanager
+    def stage(self, name):
+        profiler = None
+        if self.profile_dir:
+            with self.lock:
+                profiler = self.profilers.setdefault(name, cProfile.Profile())
+        wall, cpu = time.perf_counter(), time.thread_time()
+        if profiler is not None:
+            try:
+                profiler.enable()
+            except ValueError:
+                # Python 3.12+ allows one active profiler per process; skip overlapping stages
+                profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            with self.lock:
+                self.stage_wall[name] += time.perf_counter() - wall
+                self.stage_cpu[name] += time.thread_time() - cpu
+                self.stage_calls[name] += 1
+
+    def timed(self, name, iterable):
+        """Iterate `iterable`, timing each step as stage `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                item = next(iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+
+    def rolling(self):
+        now = time.monotonic()
+        with self.lock:
+            self._prune(now)
+            span = min(self.window, max(1e-9, time.time() - self.started))
+            return {
+                "records_per_sec": len(self.recent_records) / span,
+                "requests_per_sec": len(self.recent) / span,
+                "completion_tokens_per_sec": sum(tokens for _, tokens in self.recent) / span,
+            }
+
+    def summary(self):
+        rolling = self.rolling()
+        elapsed = time.time() - self.started
+        with self.lock:
+            ordered = sorted(self.latencies)
+            percentiles = {f"p{q}": ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))] if ordered else None
+                           for q in (50, 95, 99)}
+            return {
+                "labels": self.labels,
+                "elapsed_seconds": elapsed,
+                "counters": dict(self.counters),
+                "records_per_sec": self.counters["records"] / max(elapsed, 1e-9),
+                "completion_tokens_per_sec": self.counters["completion_tokens"] / max(elapsed, 1e-9),
+                "rolling": rolling,
+                "latency_seconds": {**percentiles, "mean": self.latency_sum / max(1, sum(self.buckets)),
+                                    "window": len(ordered)},
+                "finish_reasons": dict(self.finish_reasons),
+                "errors": dict(self.errors),
+                # where the time went, summed over concurrent requests: the model (request latency),
+                # the rate limiter and retries, or the client itself
+                "time_breakdown_seconds": {
+                    "requests": self.latency_sum,
+                    "rate_limit_wait": self.counters["rate_limit_wait_seconds"],
+                    "backoff": self.counters["backoff_seconds"],
+                    "client_cpu": sum(self.stage_cpu.values()),
+                },
+                "stages": {name: {"wall_seconds": self.stage_wall[name], "cpu_seconds": self.stage_cpu[name],
+                                  "calls": self.stage_calls[name]} for name in sorted(self.stage_wall)},
+            }
+
+    def prometheus(self):
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {PREFIX}_{name} {help}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for suffix, extra, value in samples:
+                lines.append(f"{PREFIX}_{name}{suffix}{_labels(self.labels, **extra)} {value}")
+
+        counters = summary["counters"]
+        for name, help in [("requests", "Completed requests."), ("records", "Records written."),
+                           ("prompt_tokens", "Prompt tokens of completed requests."),
+                           ("completion_tokens", "Completion tokens of completed requests."),
+                           ("retries", "Retried request attempts."), ("rate_limited", "Responses with HTTP 429."),
+                           ("cache_hits", "Responses served from the response cache."),
+                           ("invalid_responses", "Responses that were truncated or broke the template's format."),
+                           ("rejected", "Personas given up on after repeated invalid responses.")]:
+            metric(f"{name}_total", "counter", help, [("", {}, counters.get(name, 0))])
+        metric("rate_limit_wait_seconds_total", "counter", "Seconds requests waited for the client-side rate limiter.",
+               [("", {}, counters.get("rate_limit_wait_seconds", 0.0))])
+        metric("backoff_seconds_total", "counter", "Seconds requests slept before a retry.",
+               [("", {}, counters.get("backoff_seconds", 0.0))])
+        metric("finish_reason_total", "counter", "Completed requests by finish reason.",
+               [("", {"reason": reason}, n) for reason, n in summary["finish_reasons"].items()])
+        metric("errors_total", "counter", "Requests that failed after all retries, by error type.",
+               [("", {"kind": kind}, n) for kind, n in summary["errors"].items()])
+
+        with self.lock:
+            cumulative, samples = 0, []
+            for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+                cumulative += n
+                samples.append(("_bucket", {"le": "+Inf" if bound == float("inf") else bound}, cumulative))
+            samples += [("_sum", {}, self.latency_sum), ("_count", {}, cumulative)]
+        metric("request_latency_seconds", "histogram", "Latency of successful request attempts.", samples)
+
+        rolling = summary["rolling"]
+        metric("records_per_second", "gauge", f"Records written per second over the last {self.window:.0f}s.",
+               [("", {}, rolling["records_per_sec"])])
+        metric("completion_tokens_per_second", "gauge", f"Completion tokens per second over the last {self.window:.0f}s.",
+               [("", {}, rolling["completion_tokens_per_sec"])])
+        metric("stage_cpu_seconds_total", "counter", "CPU seconds spent in each pipeline stage.",
+               [("", {"stage": name}, stage["cpu_seconds"]) for name, stage in summary["stages"].items()])
+        metric("stage_wall_seconds_total", "counter", "Wall-clock seconds spent in each pipeline stage.",
+               [("", {"stage": name}, stage["wall_seconds"]) for name, stage in summary["stages"].items()])
+        return "\n".join(lines) + "\n", summary
+
+    def export(self):
+        if not self.path:
+            return
+        text, summary = self.prometheus()
+        # written atomically so the node exporter and readers never see half a file
+        for path, content in [(self.path + ".prom", text), (self.path + ".json", json.dumps(summary, indent=2))]:
+            with open(path + ".tmp", "w") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+
+    def maybe_export(self):
+        if self.path and time.monotonic() >= self.next_export:
+            self.next_export = time.monotonic() + self.interval
+            self.export()
+
+    def close(self):
+        self.export()
+        for name, profiler in self.profilers.items():
+            profiler.dump_stats(os.path.join(self.profile_dir, f"{name}.prof"))
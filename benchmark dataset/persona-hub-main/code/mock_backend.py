@@ -0,0 +1,163 @@
+import asyncio
+import random
+import re
+import time
+import types
+
+# Llama-3 chat format, as produced by the Meta-Llama-3 tokenizers' chat template
+CHAT_FORMAT = "<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>"
+# how the templates ask for the heading of the response, e.g. 'should start with "Math problem:"'
+HEADING = re.compile(r'start with "([^"]+)"')
+
+
+class LatencyModel:
+    """Random latency in seconds: `base` plus `per_token` for every generated token.
+
+    `distribution` is "fixed", "normal" (with standard deviation `jitter`) or
+    "lognormal" (median `base`, shape `jitter`), the last one giving the long
+    tail that real APIs show.
+    """
+
+    def __init__(self, base=0.0, jitter=0.0, per_token=0.0, distribution="lognormal", seed=None):
+        if distribution not in ("fixed", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution {distribution!r}.")
+        self.base = base
+        self.jitter = jitter
+        self.per_token = per_token
+        self.distribution = distribution
+        self.rng = random.Random(seed)
+
+    def sample(self, tokens=0):
+        if self.distribution == "normal":
+            base = max(0.0, self.rng.gauss(self.base, self.jitter))
+        elif self.distribution == "lognormal" and self.base > 0:
+            base = self.base * self.rng.lognormvariate(0.0, self.jitter)
+        else:
+            base = self.base
+        return base + self.per_token * tokens
+
+
+def mock_text(prompt_chars, completion_tokens, heading=""):
+    text = f"[mock reply to {prompt_chars} chars] " + " ".join(["token"] * completion_tokens)
+    return f"{heading} {text}" if heading else text
+
+
+def heading_of(user_prompt):
+    match = HEADING.search(user_prompt)
+    return match.group(1) if match else ""
+
+
+def rate_limit_error(retry_after=0.05):
+    import openai
+
+    # openai only reads these attributes of the HTTP response
+    response = types.SimpleNamespace(request=None, status_code=429, headers={"retry-after": str(retry_after)})
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+class MockAsyncOpenAI:
+    """In-process stand-in for openai.AsyncOpenAI's chat.completions.create.
+
+    Unlike mock_openai_server there is no HTTP in between, so a benchmark sees
+    only the cost of the pipeline itself. `error_rate` of the calls raise a
+    real openai.RateLimitError so the retry path of AsyncChatEngine is taken.
+    """
+
+    def __init__(self, latency=None, completion_tokens=64, error_rate=0.0, seed=None):
+        self.latency = latency or LatencyModel()
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.cpu_seconds = 0.0
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, temperature=None, **kwargs):
+        start = time.thread_time()
+        self.calls += 1
+        if self.rng.random() < self.error_rate:
+            self.errors += 1
+            self.cpu_seconds += time.thread_time() - start
+            raise rate_limit_error()
+        delay = self.latency.sample(self.completion_tokens)
+        prompt_chars = len(messages[-1]["content"])
+        heading = heading_of(messages[-1]["content"])
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        self.cpu_seconds += time.thread_time() - start
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        start = time.thread_time()
+        message = types.SimpleNamespace(role="assistant", content=mock_text(prompt_chars, self.completion_tokens, heading))
+        completion = types.SimpleNamespace(
+            model=model,
+            choices=[types.SimpleNamespace(index=0, message=message, finish_reason="stop")],
+            usage=types.SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=self.completion_tokens,
+                                        total_tokens=prompt_tokens + self.completion_tokens))
+        self.cpu_seconds += time.thread_time() - start
+        return completion
+
+    async def close(self):
+        pass
+
+
+class MockLLM:
+    """In-process stand-in for vllm.LLM.generate.
+
+    A generate call sleeps for one latency sample of the whole batch (vLLM
+    decodes a batch in lock-step, so it takes as long as its longest
+    sequence) and returns RequestOutput-like objects that start with
+    `heading`. `length_rate` of the outputs end with finish_reason "length".
+    """
+
+    def __init__(self, latency=None, completion_tokens=64, length_rate=0.0, seed=None, heading=""):
+        self.latency = latency or LatencyModel()
+        self.completion_tokens = completion_tokens
+        self.length_rate = length_rate
+        self.heading = heading
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.cpu_seconds = 0.0
+
+    def generate(self, prompts, sampling_params=None, use_tqdm=True):
+        start = time.thread_time()
+        self.calls += 1
+        outputs = []
+        for prompt in prompts:
+            token_ids = prompt["prompt_token_ids"] if isinstance(prompt, dict) else None
+            finish_reason = "length" if self.rng.random() < self.length_rate else "stop"
+            completion = types.SimpleNamespace(index=0, text=mock_text(len(token_ids or prompt), self.completion_tokens, self.heading),
+                                               token_ids=[0] * self.completion_tokens, finish_reason=finish_reason)
+            outputs.append(types.SimpleNamespace(prompt=None if token_ids is not None else prompt,
+                                                 prompt_token_ids=token_ids, outputs=[completion], finished=True))
+        self.cpu_seconds += time.thread_time() - start
+        delay = self.latency.sample(self.completion_tokens) if prompts else 0.0
+        if delay > 0:
+            time.sleep(delay)
+        return outputs
+
+
+class MockTokenizer:
+    """Byte-level tokenizer with the Llama-3 chat template.
+
+    Good enough for PrefixTokenizer and request_input_format when no real
+    tokenizer is available; pass a Hugging Face tokenizer instead to include
+    realistic BPE costs in a benchmark.
+    """
+
+    bos_token = "<|begin_of_text|>"
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=True):
+        text = self.bos_token + "".join(CHAT_FORMAT.format(**message) for message in messages)
+        if add_generation_prompt:
+            text += "<|start_header_id|>assistant<|end_header_id|>\n\n"
+        return self.encode(text) if tokenize else text
+
+    def encode(self, text, add_special_tokens=False):
+        return list(text.encode("utf-8"))
+
+    def __call__(self, texts, add_special_tokens=True):
+        if isinstance(texts, str):
+            return {"input_ids": self.encode(texts)}
+        return {"input_ids": [self.encode(text) for text in texts]}
@@ -0,0 +1,229 @@
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the OpenAI chat completions, files and batches endpoints.
+
+    Replies after a random latency and answers a configurable fraction of
+    requests with 429 so clients can be exercised without network access.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload, headers=None):
+        self.send_body(status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def read_json(self):
+        return json.loads(self.read_body() or b"{}")
+
+    def read_multipart(self):
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+        message = BytesParser(policy=default_policy).parsebytes(header + self.read_body())
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = (part.get_filename(), part.get_payload(decode=True))
+        return fields
+
+    def do_POST(self):
+        path = self.path.rstrip("/")
+        if path.endswith("/chat/completions"):
+            self.server.count("requests")
+            self.send_json(*self.server.chat_completion(self.read_json()))
+        elif path.endswith("/files"):
+            fields = self.read_multipart()
+            filename, content = fields["file"]
+            self.send_json(200, self.server.create_file(filename, content, fields["purpose"][1].decode("utf-8")))
+        elif path.endswith("/batches"):
+            self.send_json(*self.server.create_batch(self.read_json()))
+        else:
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        content = re.search(r"/files/([^/]+)/content$", path)
+        batch = re.search(r"/batches/([^/]+)$", path)
+        if content and content.group(1) in self.server.files:
+            self.send_body(200, self.server.files[content.group(1)]["content"], "application/octet-stream")
+        elif batch and batch.group(1) in self.server.batches:
+            self.send_json(200, self.server.retrieve_batch(batch.group(1)))
+        else:
+            self.send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.2, jitter=0.1, error_rate=0.0, completion_tokens=64,
+                 batch_latency=1.0, verbose=False):
+        super().__init__(address, MockOpenAIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.completion_tokens = completion_tokens
+        self.batch_latency = batch_latency
+        self.verbose = verbose
+        self.stats = {"requests": 0, "rate_limited": 0, "batches": 0, "batch_requests": 0, "batch_failures": 0}
+        self.stats_lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+        self.batch_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
+
+    def completion(self, request):
+        user_prompt = request["messages"][-1]["content"]
+        text = " ".join(["token"] * self.completion_tokens)
+        # follow the template's instruction to start with a heading, e.g. "Math problem:"
+        heading = re.search(r'start with "([^"]+)"', user_prompt)
+        prompt_tokens = sum(len(m["content"]) for m in request["messages"]) // 4
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": (f"{heading.group(1)} " if heading else "")
+                            + f"[mock reply to {len(user_prompt)} chars] {text}"},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+                "total_tokens": prompt_tokens + self.completion_tokens
+            }
+        }
+
+    def chat_completion(self, request):
+        if random.random() < self.error_rate:
+            self.count("rate_limited")
+            error = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            return 429, error, {"retry-after": "0.05"}
+
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        return 200, self.completion(request)
+
+    def create_file(self, filename, content, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        self.files[file_id] = {"content": content, "filename": filename}
+        return {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed"}
+
+    def create_batch(self, request):
+        if request.get("input_file_id") not in self.files:
+            return 400, {"error": {"message": "input file not found"}}
+        self.count("batches")
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request["completion_window"],
+            "status": "validating",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "errors": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            "metadata": request.get("metadata"),
+        }
+        return 200, dict(self.batches[batch_id])
+
+    def run_batch(self, batch):
+        # every request of the batch fails independently with probability error_rate
+        outputs, errors = [], []
+        lines = self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()
+        for line in lines:
+            request = json.loads(line)
+            if random.random() < self.error_rate:
+                errors.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                               "response": {"status_code": 500, "request_id": uuid.uuid4().hex,
+                                            "body": {"error": {"message": "The server had an error", "type": "server_error"}}},
+                               "error": None})
+            else:
+                outputs.append({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"],
+                                "response": {"status_code": 200, "request_id": uuid.uuid4().hex,
+                                             "body": self.completion(request["body"])},
+                                "error": None})
+        self.count("batch_requests", len(lines))
+        self.count("batch_failures", len(errors))
+        if outputs:
+            content = "".join(json.dumps(o) + "\n" for o in outputs).encode("utf-8")
+            batch["output_file_id"] = self.create_file("batch_output.jsonl", content, "batch_output")["id"]
+        if errors:
+            content = "".join(json.dumps(e) + "\n" for e in errors).encode("utf-8")
+            batch["error_file_id"] = self.create_file("batch_errors.jsonl", content, "batch_output")["id"]
+        batch["request_counts"] = {"total": len(lines), "completed": len(outputs), "failed": len(errors)}
+
+    def retrieve_batch(self, batch_id):
+        with self.batch_lock:
+            batch = self.batches[batch_id]
+            age = time.time() - batch["created_at"]
+            if batch["status"] == "validating" and age >= self.batch_latency / 2:
+                batch["status"] = "in_progress"
+            if batch["status"] == "in_progress" and age >= self.batch_latency:
+                self.run_batch(batch)
+                batch["status"] = "completed"
+                batch["completed_at"] = int(time.time())
+            return dict(batch)
+
+
+def start_server(host="127.0.0.1", port=0, **kwargs):
+    server = MockOpenAIServer((host, port), **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the OpenAI API.")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.2, help='Mean response latency in seconds.')
+    parser.add_argument('--jitter', type=float, default=0.1, help='Standard deviation of the response latency in seconds.')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 429 (500 inside batches).')
+    parser.add_argument('--completion_tokens', type=int, default=64, help='Number of tokens in every fake completion.')
+    parser.add_argument('--batch_latency', type=float, default=1.0, help='Seconds until a submitted batch completes.')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = MockOpenAIServer((args.host, args.port), latency=args.latency, jitter=args.jitter,
+                              error_rate=args.error_rate, completion_tokens=args.completion_tokens,
+                              batch_latency=args.batch_latency, verbose=args.verbose)
+    print(f"Mock OpenAI server listening on {server.base_url}")
+    server.serve_forever()
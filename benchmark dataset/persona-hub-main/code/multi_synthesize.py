@@ -0,0 +1,181 @@
+import argparse
+import os
+from itertools import islice
+
+from tqdm import tqdm
+from backends import OpenAIBackend, VLLMBackend, DEFAULT_MAX_TOKENS
+from dedup import dedup_personas
+from metrics import RunMetrics
+from output_writers import FORMATS as OUTPUT_FORMATS
+from persona_source import enumerate_personas
+from prompt_templates import templates as all_templates, token_budgets
+from response_cache import ResponseCache, MODES as CACHE_MODES
+from resume import open_output, key_for
+from validation import check_response, make_validator
+
+
+def make_backend(args, templates, cache, metrics):
+    validate = check_response if not args.no_validation else None
+    max_tokens = {name: args.max_tokens or token_budgets.get(name, DEFAULT_MAX_TOKENS) for name in templates}
+    if args.backend == "vllm":
+        return VLLMBackend(args.model_path, templates, tensor_parallel_size=args.tensor_parallel_size, max_tokens=max_tokens,
+                           enable_prefix_caching=not args.disable_prefix_cache, cache=cache, metrics=metrics,
+                           validate=validate)
+    client = None
+    if args.backend == "mock":
+        from mock_backend import LatencyModel, MockAsyncOpenAI
+        client = MockAsyncOpenAI(LatencyModel(args.mock_latency, args.mock_jitter))
+    return OpenAIBackend(client, concurrency=args.concurrency, rpm=args.rpm, tpm=args.tpm, max_retries=args.max_retries,
+                         cache=cache, metrics=metrics, max_tokens=max_tokens, validate=validate)
+
+
+def fan_out(personas, names, done, batch_size=4096):
+    """Yield (index, persona, template name) for every template a persona still needs."""
+    personas = iter(personas)
+    while True:
+        batch = list(islice(personas, batch_size))
+        if not batch:
+            return
+        finished = {name: done[name].contains(key_for(name, persona) for _, persona in batch).tolist()
+                    for name in names if done[name]}
+        for row, (index, persona) in enumerate(batch):
+            for name in names:
+                if name in finished and finished[name][row]:
+                    continue
+                yield index, persona, name
+
+
+def synthesize(personas, templates, backend, sinks, args, metrics, validator=None):
+    requests = fan_out(metrics.timed("load", personas), list(templates), {name: sink[1] for name, sink in sinks.items()})
+    total = 0
+    progress = tqdm(total=args.sample_size * len(templates) or None)
+    while True:
+        chunk = list(islice(requests, args.chunk_size))
+        if not chunk:
+            break
+        with metrics.stage("render"):
+            chunk = [(index, persona, name, templates[name].format(persona=persona)) for index, persona, name in chunk]
+        results = [None] * len(chunk)
+        reasons = [None] * len(chunk)
+        attempts = [0] * len(chunk)
+        todo = list(range(len(chunk)))
+        while todo:
+            outputs = backend.generate([(chunk[i][2], chunk[i][1], chunk[i][3]) for i in todo])
+            for i, result in zip(todo, outputs):
+                results[i] = result
+                if validator is not None:
+                    reasons[i] = validator.check(chunk[i][2], *result)
+            # only the failing requests are generated again, before the chunk is written, so outputs keep input order
+            todo = [i for i in todo if reasons[i] is not None and validator.retry(attempts[i])]
+            for i in todo:
+                attempts[i] += 1
+
+        written = 0
+        with metrics.stage("write"):
+            for (index, persona, name, user_prompt), (text, finish_reason), reason in zip(chunk, results, reasons):
+                record = {"user_prompt": user_prompt, "input persona": persona, "finish_reason": finish_reason,
+                          "synthesized text": text}
+                if args.num_shards > 1:
+                    # lets merge_shards.py restore the original persona order
+                    record["persona_index"] = index
+                if reason is not None:
+                    validator.reject(name, record, reason)
+                    continue
+                sinks[name][0].write(record)
+                written += 1
+            for out, _ in sinks.values():
+                out.flush()
+            if validator is not None:
+                validator.flush()
+        metrics.count("records", written)
+        total += written
+        progress.update(len(chunk))
+    progress.close()
+    return total
+
+
+def main(args):
+    templates = {name: all_templates[name] for name in args.templates}
+    if "{template}" not in args.output_path:
+        raise ValueError("--output_path must contain {template}, e.g. output/{template}.jsonl.")
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError(f"--shard_index must be in [0, {args.num_shards}).")
+
+    # Stream the dataset once for all templates
+    personas = enumerate_personas(args.dataset, args.data_files, offset=args.offset, limit=args.sample_size,
+                                  num_shards=args.num_shards, shard_index=args.shard_index)
+    if args.dedup_personas:
+        personas = dedup_personas(personas, args.output_path.replace("{template}", "all") + ".persona_clusters.jsonl",
+                                  index_dir=args.dedup_index_dir or None)
+
+    sinks = {}
+    for name in templates:
+        path = args.output_path.replace("{template}", name)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        sinks[name] = open_output(path, name, args.resume, args.output_format)
+
+    cache = ResponseCache(args.cache_path, mode=args.cache_mode, max_bytes=args.cache_max_mb * 1024 * 1024) if args.cache_path else None
+    metrics = RunMetrics(labels={"script": f"multi_{args.backend}", "template": "+".join(templates), "shard": args.shard_index},
+                         path=args.metrics_path, interval=args.metrics_interval, profile_dir=args.profile_dir)
+    validator = make_validator(args, args.output_path + ".rejected.jsonl", templates, metrics)
+    backend = make_backend(args, templates, cache, metrics)
+    try:
+        total = synthesize(personas, templates, backend, sinks, args, metrics, validator)
+    finally:
+        backend.close()
+        for out, _ in sinks.values():
+            out.close()
+        if validator is not None:
+            validator.close()
+    if validator is not None:
+        print(f"Validation: {validator.summary()}")
+    if cache is not None:
+        cache.close()
+        print(f"Response cache: {cache.stats()}")
+    metrics.close()
+
+    print(f"Synthesized {total} entries; finish reasons: {metrics.summary()['finish_reasons']}")
+    for name in templates:
+        print(f"Outputted the {name} results to: {args.output_path.replace('{template}', name)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthesize text for several templates in a single pass over the personas.")
+    parser.add_argument('--templates', type=str, nargs='+', default=list(all_templates), choices=list(all_templates))
+    parser.add_argument('--backend', type=str, required=True, choices=["openai", "vllm", "mock"],
+                        help='"mock" answers instantly (or after --mock_latency) without calling any model.')
+    parser.add_argument('--output_path', type=str, required=True, help='Output path with a {template} placeholder, e.g. output/{template}.jsonl.')
+    parser.add_argument('--output_format', type=str, default="jsonl", choices=OUTPUT_FORMATS)
+    parser.add_argument('--sample_size', type=int, default=0, help='Number of personas to process; 0 means all of them.')
+    parser.add_argument('--dataset', type=str, default="proj-persona/PersonaHub", help='HF dataset name, or a local .jsonl/.parquet file, directory or glob of personas.')
+    parser.add_argument('--data_files', type=str, default="persona.jsonl", help='Data files of the HF dataset to stream.')
+    parser.add_argument('--offset', type=int, default=0, help='Number of personas to skip at the start of the dataset.')
+    parser.add_argument('--num_shards', type=int, default=1, help='Split the dataset into this many shards by a stable persona hash.')
+    parser.add_argument('--shard_index', type=int, default=0, help='Shard processed by this worker, in [0, num_shards).')
+    parser.add_argument('--dedup_personas', action='store_true', help='Skip near-duplicate personas (MinHash/LSH).')
+    parser.add_argument('--dedup_index_dir', type=str, default="", help='Keep the --dedup_personas index in memory-mapped files in this directory instead of RAM.')
+    parser.add_argument('--resume', action='store_true', help='Append to existing outputs and skip (persona, template) pairs they already contain.')
+    parser.add_argument('--chunk_size', type=int, default=4096, help='Requests per backend call; a vLLM chunk mixes all templates.')
+    parser.add_argument('--max_tokens', type=int, default=0, help='Token budget of every response; 0 uses each template\'s budget in prompt_templates.token_budgets.')
+    parser.add_argument('--invalid_retries', type=int, default=2, help='Times a truncated or malformed response is generated again (within its chunk) before it goes to <output_path>.rejected.jsonl.')
+    parser.add_argument('--no_validation', action='store_true', help='Write every response as it is, without checking the template\'s format.')
+    parser.add_argument('--model_path', type=str, default="", help='Model for the vllm backend.')
+    parser.add_argument('--tensor_parallel_size', type=int, default=4, help='Number of GPUs the vLLM model is split over.')
+    parser.add_argument('--disable_prefix_cache', action='store_true', help='Tokenize every prompt in full and turn off vLLM prefix caching.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Maximum number of OpenAI requests in flight.')
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per minute limit of your OpenAI account; 0 disables it.')
+    parser.add_argument('--tpm', type=int, default=0, help='Tokens per minute limit of your OpenAI account; 0 disables it.')
+    parser.add_argument('--max_retries', type=int, default=8, help='Retries per request on 429/5xx/connection errors.')
+    parser.add_argument('--mock_latency', type=float, default=0.0, help='Median latency in seconds of the mock backend.')
+    parser.add_argument('--mock_jitter', type=float, default=0.0, help='Lognormal shape of the mock backend latency.')
+    parser.add_argument('--cache_path', type=str, default="", help='SQLite file used to cache responses across runs; empty disables the cache.')
+    parser.add_argument('--cache_mode', type=str, default="readwrite", choices=CACHE_MODES, help='Read-through, write-through or both.')
+    parser.add_argument('--cache_max_mb', type=int, default=0, help='Size cap of the cache in MB with LRU eviction; 0 means unbounded.')
+    parser.add_argument('--metrics_path', type=str, default="", help='Export metrics to <metrics_path>.prom (Prometheus textfile) and <metrics_path>.json.')
+    parser.add_argument('--metrics_interval', type=float, default=30.0, help='Seconds between metrics exports.')
+    parser.add_argument('--profile_dir', type=str, default="", help='Run each pipeline stage under cProfile and write <stage>.prof files here.')
+    args = parser.parse_args()
+    if args.backend == "vllm" and not args.model_path:
+        parser.error("--model_path is required for the vllm backend")
+    main(args)
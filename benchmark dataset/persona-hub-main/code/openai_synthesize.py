@@ -1,14 +1,31 @@
 import argparse
-import json
-from openai import OpenAI
-from prompt_templates import instruction_template, knowledge_template, npc_template, math_template
-from datasets import load_dataset
+import asyncio
+import time
+from functools import partial
+from openai import OpenAI, AsyncOpenAI
+from async_engine import AsyncChatEngine
+from batch_synthesize import BatchRunner
+from resume import open_output
+from output_writers import FORMATS as OUTPUT_FORMATS
+from response_cache import ResponseCache, make_key, MODES as CACHE_MODES
+from prompt_templates import templates, token_budgets
+from persona_source import enumerate_personas
+from dedup import dedup_personas
+from metrics import RunMetrics
+from validation import check_response, make_validator
 from tqdm import tqdm
 
 system_prompt = '''You are a helpful assistant.'''
 client = OpenAI()   # set up your config/env/api for calling openai models
+async_client = AsyncOpenAI(max_retries=0)   # retries are handled by AsyncChatEngine
 
-def get_response(user_prompt):
+def get_response(user_prompt, cache=None, metrics=None):
+    if cache is not None:
+        key = make_key("gpt-4o", 0.7, system_prompt, user_prompt)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    start = time.monotonic()
     completion = client.chat.completions.create(
         model="gpt-4o",
         temperature=0.7,
@@ -17,51 +34,164 @@ def get_response(user_prompt):
             {"role": "user", "content": f"{user_prompt}"}
         ]
     )
+    if metrics is not None:
+        usage = completion.usage
+        metrics.record_request(time.monotonic() - start, usage.prompt_tokens if usage else 0,
+                               usage.completion_tokens if usage else 0, finish_reason=completion.choices[0].finish_reason)
+    if cache is not None and completion.choices[0].message.content is not None:
+        cache.put(key, completion.choices[0].message.content)
     return completion.choices[0].message.content
 
+def make_record(args, index, persona, user_prompt, gpt4o_out_text):
+    o = {"user_prompt": user_prompt, "input persona": persona, "synthesized text": gpt4o_out_text}
+    if args.num_shards > 1:
+        # lets merge_shards.py restore the original persona order
+        o["persona_index"] = index
+    return o
+
+def write_record(out, args, index, persona, user_prompt, gpt4o_out_text):
+    out.write(make_record(args, index, persona, user_prompt, gpt4o_out_text))
+
+def synthesize_batch(personas, template, out, args, cache=None, metrics=None, validator=None):
+    metrics = metrics or RunMetrics()
+    # invalid responses stay pending and are resubmitted with the failed requests of their batch
+    runner = BatchRunner(client, args.batch_dir or args.output_path + ".batches", model="gpt-4o", temperature=0.7,
+                         system_prompt=system_prompt, max_active=args.batch_max_active,
+                         max_attempts=args.batch_max_attempts, poll_interval=args.batch_poll_interval, cache=cache,
+                         metrics=metrics, max_tokens=args.max_tokens or token_budgets.get(args.template),
+                         validate=partial(validator.check, args.template) if validator is not None else None)
+
+    def write(*record):
+        with metrics.stage("write"):
+            write_record(out, args, *record)
+        metrics.count("records")
+
+    def reject(*record, reason):
+        validator.reject(args.template, make_record(args, *record), reason)
+
+    runner.run(metrics.timed("load", personas), template, write, reject)
+
+async def synthesize(personas, template, out, args, cache=None, client=None, metrics=None, validator=None):
+    metrics = metrics or RunMetrics()
+    engine = AsyncChatEngine(client or async_client, model="gpt-4o", system_prompt=system_prompt, temperature=0.7,
+                             max_in_flight=args.concurrency, rpm=args.rpm, tpm=args.tpm, max_retries=args.max_retries,
+                             cache=cache, metrics=metrics)
+    validate = partial(check_response, args.template) if validator is not None else None
+    max_tokens = args.max_tokens or token_budgets.get(args.template)
+
+    async def request(item):
+        index, persona = item
+        with metrics.stage("render"):
+            user_prompt = template.format(persona=persona)
+        attempt = 0
+        while True:
+            gpt4o_out_text, finish_reason = await engine.complete_choice(user_prompt, validate, max_tokens)
+            reason = validator.check(args.template, gpt4o_out_text, finish_reason) if validator is not None else None
+            # only this persona is asked again; the rest of the stream keeps going
+            if reason is None or not validator.retry(attempt):
+                return index, persona, user_prompt, gpt4o_out_text, reason
+            attempt += 1
+
+    # results arrive in input order even though requests complete out of order
+    progress = tqdm(total=args.sample_size or None)
+    async for index, persona, user_prompt, gpt4o_out_text, reason in engine.map_ordered(metrics.timed("load", personas), request):
+        with metrics.stage("write"):
+            if reason is not None:
+                validator.reject(args.template, make_record(args, index, persona, user_prompt, gpt4o_out_text), reason)
+            else:
+                write_record(out, args, index, persona, user_prompt, gpt4o_out_text)
+        if reason is None:
+            metrics.count("records")
+        progress.update(1)
+    progress.close()
+
 def main(args):
     # Load the appropriate template
-    if args.template == "instruction":
-        template = instruction_template
-    elif args.template == "knowledge":
-        template = knowledge_template
-    elif args.template == "npc":
-        template = npc_template
-    elif args.template == "math":
-        template = math_template
-    else:
-        raise ValueError("Invalid template type. Choose from 'instruction', 'knowledge', 'npc', or 'math'.")
-
-    # Load the dataset
-    persona_dataset = load_dataset("proj-persona/PersonaHub", data_files="persona.jsonl")['train']
-    if args.sample_size > 0:
-        persona_dataset = persona_dataset[:args.sample_size]
-    print(f"Total number of input personas: {len(persona_dataset['persona'])}")
-
-    with open(args.output_path, "w") as out:
-        for persona in tqdm(persona_dataset['persona']):
-            persona = persona.strip()
-            user_prompt = template.format(persona=persona)
-            gpt4o_out_text = get_response(user_prompt)
-            o = {"user_prompt": user_prompt, "input persona": persona, "synthesized text": gpt4o_out_text}
-            out.write(json.dumps(o, ensure_ascii=False) + '\n')
+    template = templates[args.template]
+
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError(f"--shard_index must be in [0, {args.num_shards}).")
+
+    # Stream the dataset
+    personas = enumerate_personas(args.dataset, args.data_files, offset=args.offset, limit=args.sample_size,
+                                  num_shards=args.num_shards, shard_index=args.shard_index)
+    if args.dedup_personas:
+        # drop near-duplicate personas before any request is made for them
+        personas = dedup_personas(personas, args.output_path + ".persona_clusters.jsonl",
+                                  index_dir=args.dedup_index_dir or None)
+    print(f"Reading input personas from {args.dataset} starting at offset {args.offset}"
+          + (f", at most {args.sample_size}" if args.sample_size > 0 else "")
+          + (f", shard {args.shard_index} of {args.num_shards}" if args.num_shards > 1 else ""))
+
+    out, done = open_output(args.output_path, args.template, args.resume, args.output_format)
+    if done:
+        personas = done.filter(args.template, personas)
+
+    cache = ResponseCache(args.cache_path, mode=args.cache_mode, max_bytes=args.cache_max_mb * 1024 * 1024) if args.cache_path else None
+    metrics = RunMetrics(labels={"script": "openai", "template": args.template, "shard": args.shard_index},
+                         path=args.metrics_path, interval=args.metrics_interval, profile_dir=args.profile_dir)
+    validator = make_validator(args, args.output_path + ".rejected.jsonl", [args.template], metrics)
+    if validator is not None and args.batch:
+        validator.max_attempts = args.batch_max_attempts
+    with out:
+        if args.batch:
+            synthesize_batch(personas, template, out, args, cache, metrics, validator)
+        else:
+            asyncio.run(synthesize(personas, template, out, args, cache, metrics=metrics, validator=validator))
+    if validator is not None:
+        validator.close()
+        print(f"Validation: {validator.summary()}")
+    if cache is not None:
+        cache.close()
+        print(f"Response cache: {cache.stats()}")
+    metrics.close()
+    summary = metrics.summary()
+    print(f"Requests: {summary['counters'].get('requests', 0)}, retries: {summary['counters'].get('retries', 0)}, "
+          f"completion tokens/s: {summary['completion_tokens_per_sec']:.1f}, finish reasons: {summary['finish_reasons']}")
 
     print(f"Outputted the results to: {args.output_path}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Synthesize text using a specified model and template.")
     parser.add_argument('--sample_size', type=int, default=0, help='Number of samples to process from the dataset; Set it to 0 if you want to use the full set of 200k personas.')
+    parser.add_argument('--dataset', type=str, default="proj-persona/PersonaHub", help='HF dataset name, or a local .jsonl/.parquet file, directory or glob of personas.')
+    parser.add_argument('--data_files', type=str, default="persona.jsonl", help='Data files of the HF dataset to stream, e.g. persona.jsonl or ElitePersonas/*.jsonl.')
+    parser.add_argument('--offset', type=int, default=0, help='Number of personas to skip at the start of the dataset.')
     parser.add_argument(
         '--template', 
         type=str, 
         required=True, 
-        choices=['instruction', 'knowledge', 'npc', 'math'], 
+        choices=list(templates), 
         help=(
             "Prompt templates. Choose from 'instruction', 'knowledge', 'math' or 'npc'. "
-            "You can also add more customized templates in prompt_templates.py"
+            "You can also add more customized templates to `templates` in prompt_templates.py"
         )
     )
     parser.add_argument('--output_path', type=str, required=True, help='Path to the output file.')
+    parser.add_argument('--output_format', type=str, default="jsonl", choices=OUTPUT_FORMATS, help='jsonl, or parquet for a directory of zstd-compressed Parquet files.')
+    parser.add_argument('--num_shards', type=int, default=1, help='Split the dataset into this many shards by a stable persona hash.')
+    parser.add_argument('--shard_index', type=int, default=0, help='Shard processed by this worker, in [0, num_shards).')
+    parser.add_argument('--dedup_personas', action='store_true', help='Skip near-duplicate personas (MinHash/LSH); clusters are written next to the output file.')
+    parser.add_argument('--dedup_index_dir', type=str, default="", help='Keep the --dedup_personas index in memory-mapped files in this directory instead of RAM.')
+    parser.add_argument('--resume', action='store_true', help='Append to an existing output file and skip personas it already contains.')
+    parser.add_argument('--cache_path', type=str, default="", help='SQLite file used to cache responses across runs; empty disables the cache.')
+    parser.add_argument('--cache_mode', type=str, default="readwrite", choices=CACHE_MODES, help='Read-through, write-through or both.')
+    parser.add_argument('--cache_max_mb', type=int, default=0, help='Size cap of the cache in MB with LRU eviction; 0 means unbounded.')
+    parser.add_argument('--batch', action='store_true', help='Use the OpenAI Batch API instead of one request per persona.')
+    parser.add_argument('--batch_dir', type=str, default="", help='Directory for batch input files and the batch manifest; defaults to <output_path>.batches.')
+    parser.add_argument('--batch_max_active', type=int, default=4, help='Maximum number of batches running at the same time.')
+    parser.add_argument('--batch_max_attempts', type=int, default=3, help='Attempts per request before it is given up.')
+    parser.add_argument('--batch_poll_interval', type=float, default=10.0, help='Initial seconds between status polls; backs off up to 5 minutes.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Maximum number of requests in flight at the same time.')
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per minute limit of your OpenAI account; 0 disables it.')
+    parser.add_argument('--tpm', type=int, default=0, help='Tokens per minute limit of your OpenAI account; 0 disables it.')
+    parser.add_argument('--max_retries', type=int, default=8, help='Retries per request on 429/5xx/connection errors.')
+    parser.add_argument('--max_tokens', type=int, default=0, help='Token budget of a response; 0 uses the template\'s budget in prompt_templates.token_budgets.')
+    parser.add_argument('--invalid_retries', type=int, default=2, help='Times a truncated or malformed response is generated again before the persona goes to <output_path>.rejected.jsonl. In --batch mode invalid responses are resubmitted up to --batch_max_attempts instead.')
+    parser.add_argument('--no_validation', action='store_true', help='Write every response as it is, without checking the template\'s format.')
+    parser.add_argument('--metrics_path', type=str, default="", help='Export metrics to <metrics_path>.prom (Prometheus textfile) and <metrics_path>.json.')
+    parser.add_argument('--metrics_interval', type=float, default=30.0, help='Seconds between metrics exports.')
+    parser.add_argument('--profile_dir', type=str, default="", help='Run each pipeline stage under cProfile and write <stage>.prof files here.')
 
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,172 @@
+import glob
+import json
+import os
+
+FORMATS = ["jsonl", "parquet"]
+PERSONA_FIELD = "input persona"
+PROMPT_FIELDS = ("user_prompt", "prompt")
+
+
+class JsonlWriter:
+    """One JSON object per line, as the synthesize scripts have always written."""
+
+    def __init__(self, path, mode="w"):
+        self.path = path
+        self.file = open(path, mode)
+
+    def write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParquetWriter:
+    """Writes records as zstd-compressed, dictionary-encoded Parquet part files in a directory.
+
+    The prompt of every record is the same template text around the persona,
+    so it is stored once in the schema metadata (as the text before and after
+    the persona) and the prompt column is left null wherever the prompt can
+    be rebuilt from it. Rows are buffered into row groups of `row_group_size`
+    and each part file is renamed into place only once it is complete. A part
+    is completed every `rows_per_file` rows and by flush(), so a crash loses
+    at most the rows written since the last flush or the last few row groups.
+    """
+
+    def __init__(self, path, template_name="", row_group_size=10000, rows_per_file=50000, compression_level=None):
+        import pyarrow  # noqa: F401  (fail early if pyarrow is missing)
+
+        self.path = path
+        self.template_name = template_name
+        self.row_group_size = row_group_size
+        self.rows_per_file = rows_per_file
+        self.compression_level = compression_level
+        self.rows = []
+        self.schema = None
+        self.writer = None
+        self.file_rows = 0
+        os.makedirs(path, exist_ok=True)
+        for tmp in glob.glob(os.path.join(path, "*.parquet.tmp")):
+            os.remove(tmp)
+        parts = sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+        self.next_part = int(os.path.basename(parts[-1])[5:10]) + 1 if parts else 0
+
+    def existing_personas(self):
+        import pyarrow.parquet as pq
+
+        for part in sorted(glob.glob(os.path.join(self.path, "part-*.parquet"))):
+            for batch in pq.ParquetFile(part).iter_batches(columns=[PERSONA_FIELD]):
+                yield from batch.column(0).to_pylist()
+
+    def _make_schema(self, rows):
+        import pyarrow as pa
+
+        first = rows[0]
+        fields = [pa.field(key, pa.int64() if isinstance(value, int) else pa.string()) for key, value in first.items()]
+        metadata = {"persona_hub.template": self.template_name}
+        prompt_field = next((field for field in PROMPT_FIELDS if field in first), None)
+        persona = first.get(PERSONA_FIELD)
+        if prompt_field and persona and first[prompt_field].count(persona) == 1:
+            prefix, suffix = first[prompt_field].split(persona)
+            metadata.update({"persona_hub.prompt_field": prompt_field,
+                             "persona_hub.prompt_prefix": prefix,
+                             "persona_hub.prompt_suffix": suffix})
+        return pa.schema(fields, metadata=metadata)
+
+    def _compact(self, record):
+        metadata = self.schema.metadata
+        prompt_field = metadata.get(b"persona_hub.prompt_field", b"").decode("utf-8")
+        if prompt_field:
+            prefix = metadata[b"persona_hub.prompt_prefix"].decode("utf-8")
+            suffix = metadata[b"persona_hub.prompt_suffix"].decode("utf-8")
+            if record[prompt_field] == prefix + record[PERSONA_FIELD] + suffix:
+                record = dict(record)
+                record[prompt_field] = None
+        return record
+
+    def _write_row_group(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if not self.rows:
+            return
+        if self.schema is None:
+            self.schema = self._make_schema(self.rows)
+        if self.writer is None:
+            self.part_path = os.path.join(self.path, f"part-{self.next_part:05d}.parquet")
+            self.writer = pq.ParquetWriter(self.part_path + ".tmp", self.schema, compression="zstd",
+                                           compression_level=self.compression_level, use_dictionary=True)
+        table = pa.Table.from_pylist([self._compact(record) for record in self.rows], schema=self.schema)
+        self.writer.write_table(table, row_group_size=self.row_group_size)
+        self.file_rows += len(self.rows)
+        self.rows = []
+        if self.file_rows >= self.rows_per_file:
+            self._close_part()
+
+    def _close_part(self):
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.part_path + ".tmp", self.part_path)
+            self.writer = None
+            self.file_rows = 0
+            self.next_part += 1
+
+    def write(self, record):
+        self.rows.append(record)
+        if len(self.rows) >= self.row_group_size:
+            self._write_row_group()
+
+    def flush(self):
+        # complete the current part so its row groups survive a crash; rows
+        # short of a full row group stay buffered rather than making small ones
+        self._close_part()
+
+    def close(self):
+        self._write_row_group()
+        self._close_part()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_output(path, columns=None, memory_map=True, restore_prompts=True):
+    """Read a Parquet output directory (or file) as a pyarrow Table, memory-mapped by default.
+
+    Prompts that were stored only once in the metadata are rebuilt unless
+    `restore_prompts` is False.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    files = sorted(glob.glob(os.path.join(path, "part-*.parquet"))) if os.path.isdir(path) else [path]
+    if not files:
+        raise FileNotFoundError(f"No Parquet parts found in {path}")
+    metadata = pq.read_schema(files[0]).metadata or {}
+    prompt_field = metadata.get(b"persona_hub.prompt_field", b"").decode("utf-8")
+    read_columns = columns
+    if columns is not None and prompt_field in columns and PERSONA_FIELD not in columns:
+        read_columns = list(columns) + [PERSONA_FIELD]
+    table = pa.concat_tables([pq.read_table(f, columns=read_columns, memory_map=memory_map) for f in files])
+
+    if restore_prompts and prompt_field and prompt_field in table.column_names:
+        rebuilt = pc.binary_join_element_wise(metadata[b"persona_hub.prompt_prefix"].decode("utf-8"),
+                                              table[PERSONA_FIELD],
+                                              metadata[b"persona_hub.prompt_suffix"].decode("utf-8"), "")
+        prompts = pc.coalesce(table[prompt_field], rebuilt)
+        table = table.set_column(table.column_names.index(prompt_field), prompt_field, prompts)
+    if columns is not None:
+        table = table.select(columns)
+    return table
@@ -0,0 +1,168 @@
+import glob
+import json
+import os
+import re
+
+from datasets import load_dataset
+from sharding import shard_of
+
+CHUNK_SIZE = 16 * 1024 * 1024
+# a blank line after a newline; one at the start of a block is checked with BLANK_FIRST_LINE
+BLANK_LINE = re.compile(rb"\n[ \t\r\f\v]*(?=\n)")
+BLANK_FIRST_LINE = re.compile(rb"[ \t\r\f\v]*\n")
+
+
+def _expand(path):
+    if "://" in path:
+        import fsspec
+
+        if not glob.has_magic(path):
+            return [path]
+        fs, _ = fsspec.core.url_to_fs(path)
+        return sorted(fs.unstrip_protocol(file) for file in fs.glob(path))
+    if os.path.isdir(path):
+        files = glob.glob(os.path.join(path, "*.jsonl")) + glob.glob(os.path.join(path, "*.parquet"))
+    elif glob.has_magic(path):
+        files = glob.glob(path)
+    else:
+        files = [path]
+    return sorted(files)
+
+
+def _is_local_source(dataset):
+    return os.path.isdir(dataset) or dataset.endswith((".jsonl", ".parquet")) or glob.has_magic(dataset)
+
+
+def _skip_lines(f, n):
+    """Advance a binary file past `n` records without parsing them; returns how many were skipped.
+
+    Records are counted like the JSONL reader sees them: blank lines are not
+    records, and a non-empty last line without a trailing newline is one.
+    """
+    skipped = 0
+    tail = b""
+    while skipped < n:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            if tail.strip():
+                skipped += 1
+            break
+        block = tail + chunk
+        block_start = f.tell() - len(block)
+        # count whole lines only; the unterminated rest is carried into the next block
+        cut = block.rfind(b"\n") + 1
+        count = block.count(b"\n", 0, cut)
+        # JSONL records start with "{", so blank lines are only searched for when some line does not
+        clean = block.startswith(b"{") + block.count(b"\n{", 0, cut - 1) == count
+        if not clean:
+            count -= len(BLANK_LINE.findall(block, 0, cut)) + (BLANK_FIRST_LINE.match(block) is not None)
+        if skipped + count < n:
+            skipped += count
+            tail = block[cut:]
+            continue
+        pos = 0
+        while skipped < n:
+            end = block.index(b"\n", pos) + 1
+            if clean or block[pos:end].strip():
+                skipped += 1
+            pos = end
+        f.seek(block_start + pos)
+    return skipped
+
+
+def _iter_jsonl(path, offset, field):
+    import fsspec
+
+    with fsspec.open(path, "rb") as f:
+        skipped = _skip_lines(f, offset)
+        yield skipped
+        for line in f:
+            if line.strip():
+                yield json.loads(line)[field]
+
+
+def _iter_parquet(path, offset, field):
+    import fsspec
+    import pyarrow.parquet as pq
+
+    with fsspec.open(path, "rb") as f:
+        parquet_file = pq.ParquetFile(f)
+        metadata = parquet_file.metadata
+        if offset >= metadata.num_rows:
+            yield metadata.num_rows
+            return
+        yield offset
+        # whole row groups before the offset are skipped using the footer metadata alone
+        first_group = 0
+        skipped = 0
+        while skipped + metadata.row_group(first_group).num_rows <= offset:
+            skipped += metadata.row_group(first_group).num_rows
+            first_group += 1
+        to_drop = offset - skipped
+        row_groups = range(first_group, metadata.num_row_groups)
+        for batch in parquet_file.iter_batches(row_groups=row_groups, columns=[field]):
+            values = batch.column(0).to_pylist()
+            if to_drop:
+                dropped = min(to_drop, len(values))
+                values = values[dropped:]
+                to_drop -= dropped
+            yield from values
+
+
+def _iter_local(dataset, offset, field):
+    for path in _expand(dataset):
+        reader = _iter_parquet if path.endswith(".parquet") else _iter_jsonl
+        records = reader(path, offset, field)
+        # every reader first reports how many rows of the offset it consumed
+        offset -= next(records)
+        yield from records
+
+
+def _hub_url(dataset, data_files):
+    """The hf:// URL of a hub dataset's .jsonl/.parquet data files, which _iter_local can read and skip into."""
+    if isinstance(data_files, str) and data_files.endswith((".jsonl", ".parquet")):
+        return f"hf://datasets/{dataset}/{data_files}"
+    return None
+
+
+def _iter_hub(dataset, data_files, offset, field):
+    # other data file formats go through `datasets`, whose skip() still parses every skipped row
+    stream = load_dataset(dataset, data_files=data_files, split="train", streaming=True)
+    if offset > 0:
+        stream = stream.skip(offset)
+    for record in stream:
+        yield record[field]
+
+
+def enumerate_personas(dataset="proj-persona/PersonaHub", data_files="persona.jsonl", offset=0, limit=0,
+                       field="persona", num_shards=1, shard_index=0):
+    """Lazily yield (index, persona) pairs from a local JSONL/Parquet source or a streamed HF dataset.
+
+    `dataset` is either a HF dataset name or a local file, directory or glob of
+    .jsonl/.parquet files (paths may also be remote fsspec URLs such as
+    hf://datasets/...; hub datasets whose data_files are .jsonl or .parquet
+    are read through such URLs). Only the window [offset, offset + limit) is read; limit=0
+    means until the end. `index` is the position in the source, and with
+    num_shards > 1 only personas whose stable hash falls into `shard_index` are
+    kept, so every worker sees the same window but a disjoint part of it.
+    Memory use does not depend on the size of the source.
+    """
+    if _is_local_source(dataset) or dataset.startswith("hf://"):
+        records = _iter_local(dataset, offset, field)
+    elif _hub_url(dataset, data_files):
+        records = _iter_local(_hub_url(dataset, data_files), offset, field)
+    else:
+        records = _iter_hub(dataset, data_files, offset, field)
+    for i, persona in enumerate(records):
+        if limit > 0 and i >= limit:
+            break
+        persona = persona.strip()
+        if num_shards > 1 and shard_of(persona, num_shards) != shard_index:
+            continue
+        yield offset + i, persona
+
+
+def iter_personas(*args, **kwargs):
+    """Like enumerate_personas, but yields the personas only."""
+    for _, persona in enumerate_personas(*args, **kwargs):
+        yield persona
@@ -0,0 +1,57 @@
+import warnings
+
+# placeholder substituted for {persona} to find where the static part of a rendered prompt ends
+PERSONA_SLOT = "persona"
+
+
+class PrefixTokenizer:
+    """Tokenizes the static part of a chat prompt once and reuses it for every persona.
+
+    `render(user_prompt)` must return the full chat-formatted prompt text (e.g.
+    vllm_synthesize.request_input_format). Everything before {persona} is
+    tokenized once; per persona only the persona and the (usually short) rest
+    of the template are tokenized. Because BPE merges could in principle
+    cross the split point, the first `verify` personas are also tokenized the
+    slow way and the cache switches itself off on any mismatch.
+    """
+
+    def __init__(self, tokenizer, template, render, verify=16, enabled=True):
+        self.tokenizer = tokenizer
+        self.template = template
+        self.render = render
+        self.verify = verify
+        self.enabled = enabled
+        if not enabled:
+            return
+
+        rendered = render(template.format(persona=PERSONA_SLOT))
+        if rendered.count(PERSONA_SLOT) != 1:
+            warnings.warn("Persona does not appear exactly once in the rendered prompt; prefix cache disabled.")
+            self.enabled = False
+            return
+        self.prefix_text, self.suffix_text = rendered.split(PERSONA_SLOT)
+        self.prefix_ids = tokenizer.encode(self.prefix_text, add_special_tokens=False)
+
+    def full_render(self, personas):
+        prompts = [self.render(self.template.format(persona=persona)) for persona in personas]
+        token_ids = self.tokenizer(prompts, add_special_tokens=False)["input_ids"] if prompts else []
+        return prompts, token_ids
+
+    def __call__(self, personas):
+        """Return (prompt texts, prompt token IDs) for a batch of personas."""
+        if not self.enabled or not personas:
+            return self.full_render(personas)
+        tails = [persona + self.suffix_text for persona in personas]
+        tail_ids = self.tokenizer(tails, add_special_tokens=False)["input_ids"]
+        prompts = [self.prefix_text + tail for tail in tails]
+        token_ids = [self.prefix_ids + ids for ids in tail_ids]
+
+        if self.verify > 0:
+            n = min(self.verify, len(personas))
+            self.verify -= n
+            _, expected = self.full_render(personas[:n])
+            if [list(ids) for ids in expected] != token_ids[:n]:
+                warnings.warn("Cached prefix tokens differ from full tokenization; prefix cache disabled.")
+                self.enabled = False
+                return self.full_render(personas)
+        return prompts, token_ids
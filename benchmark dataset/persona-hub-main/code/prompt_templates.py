@@ -230,3 +230,26 @@ Note:
 2. Your NPC description should be specific and consistent with the game.
 3. You also need to specify how the NPC interacts with players in the game.
 '''
+
+templates = {
+    "instruction": instruction_template,
+    "knowledge": knowledge_template,
+    "npc": npc_template,
+    "math": math_template,
+}
+
+# upper bound on the length of a response to each template, in tokens
+token_budgets = {
+    "instruction": 512,
+    "knowledge": 2048,
+    "npc": 1024,
+    "math": 1024,
+}
+
+# the heading each template asks the response to start with
+response_headings = {
+    "instruction": "User prompt:",
+    "knowledge": "Title:",
+    "npc": "Name:",
+    "math": "Math problem:",
+}
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+MODES = ["off", "read", "write", "readwrite"]
+
+
+def make_key(model, temperature, system_prompt, user_prompt):
+    payload = json.dumps([model, temperature, system_prompt, user_prompt], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Content-addressed response store in a single SQLite file.
+
+    `mode` selects read-through ("read"), write-through ("write"), both
+    ("readwrite") or nothing ("off"). The database runs in WAL mode so several
+    processes can share one file. When `max_bytes` > 0 the least recently used
+    responses are evicted once the stored text exceeds the cap.
+    """
+
+    def __init__(self, path, mode="readwrite", max_bytes=0, evict_every=512):
+        if mode not in MODES:
+            raise ValueError(f"Invalid cache mode {mode!r}. Choose from {MODES}.")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if mode == "off":
+            return
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                        "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    @property
+    def readable(self):
+        return self.mode in ("read", "readwrite")
+
+    @property
+    def writable(self):
+        return self.mode in ("write", "readwrite")
+
+    def get(self, key):
+        if not self.readable:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, response):
+        if not self.writable:
+            return
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses (key, response, size, last_used) VALUES (?, ?, ?, ?)",
+                            (key, response, len(response.encode("utf-8")), time.time()))
+            self.writes += 1
+            if self.max_bytes > 0 and self.writes % self.evict_every == 0:
+                self._evict()
+
+    def _evict(self):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # evict down to 90% of the cap so that eviction does not run on every check
+        target = total - int(self.max_bytes * 0.9)
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            freed = 0
+            stale = []
+            for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY last_used"):
+                if freed >= target:
+                    break
+                stale.append((key,))
+                freed += size
+            self.db.executemany("DELETE FROM responses WHERE key = ?", stale)
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        self.evictions += len(stale)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"mode": self.mode, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "writes": self.writes, "evictions": self.evictions}
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                if self.max_bytes > 0 and self.writable:
+                    self._evict()
+                self.db.close()
+                self.db = None
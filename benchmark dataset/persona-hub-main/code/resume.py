@@ -0,0 +1,133 @@
+import array
+import hashlib
+import json
+import os
+import re
+from itertools import islice
+
+import numpy as np
+
+from output_writers import JsonlWriter, ParquetWriter
+
+# Records are written with json.dumps(..., ensure_ascii=False), so the encoded persona
+# can be pulled out of each line with a regex and hashed as raw bytes without parsing
+# the (much larger) prompt and synthesized text fields.
+PERSONA_FIELD = re.compile(rb'"input persona": ("(?:[^"\\]|\\.)*")')
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def persona_key(template_name, encoded_persona):
+    h = hashlib.blake2b(digest_size=8)
+    h.update(template_name.encode("utf-8"))
+    h.update(b"\0")
+    h.update(encoded_persona)
+    return int.from_bytes(h.digest(), "little")
+
+
+def key_for(template_name, persona):
+    return persona_key(template_name, json.dumps(persona, ensure_ascii=False).encode("utf-8"))
+
+
+class DoneKeys:
+    """The (template, persona) keys an output already holds, as a sorted NumPy uint64 array.
+
+    Eight bytes per key, so the keys of a 10M-record output take 80 MB;
+    membership is tested for whole batches at once with np.searchsorted.
+    """
+
+    def __init__(self, keys=()):
+        self.keys = np.unique(np.fromiter(keys, dtype=np.uint64))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contains(self, keys):
+        """Return a boolean array telling which of `keys` are finished."""
+        keys = np.fromiter(keys, dtype=np.uint64)
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=bool)
+        position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[position] == keys
+
+    def __contains__(self, key):
+        return bool(self.contains([key])[0])
+
+    def filter(self, template_name, personas, batch_size=4096):
+        """Lazily drop the (index, persona) pairs whose persona is finished for `template_name`."""
+        personas = iter(personas)
+        while True:
+            batch = list(islice(personas, batch_size))
+            if not batch:
+                return
+            finished = self.contains(key_for(template_name, persona) for _, persona in batch)
+            for item, skip in zip(batch, finished.tolist()):
+                if not skip:
+                    yield item
+
+
+def drop_partial_line(path):
+    """Truncate a trailing line that was cut off by a crash; returns the number of bytes dropped."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+    with open(path, "rb+") as f:
+        end = size
+        while end > 0:
+            start = max(0, end - CHUNK_SIZE)
+            f.seek(start)
+            block = f.read(end - start)
+            pos = block.rfind(b"\n")
+            if pos != -1:
+                keep = start + pos + 1
+                break
+            end = start
+        else:
+            keep = 0
+        if keep != size:
+            f.truncate(keep)
+    return size - keep
+
+
+def load_done_keys(path, template_name):
+    """Scan a JSONL output file and return the DoneKeys of the (template, persona) pairs it already holds."""
+    keys = array.array("Q")
+    with open(path, "rb") as f:
+        tail = b""
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk = tail + chunk
+            cut = chunk.rfind(b"\n") + 1
+            tail = chunk[cut:]
+            for match in PERSONA_FIELD.finditer(chunk, 0, cut):
+                keys.append(persona_key(template_name, match.group(1)))
+    return DoneKeys(keys)
+
+
+def open_output(path, template_name, resume, output_format="jsonl"):
+    """Open the output for writing, returning (writer, DoneKeys of the finished personas).
+
+    With `resume`, a half-written last line is dropped and the file is opened
+    for appending; otherwise the file is truncated as before. Parquet outputs
+    are directories of part files; resuming adds new parts next to the
+    complete ones.
+    """
+    if output_format == "parquet":
+        exists = os.path.isdir(path) and os.listdir(path)
+        if exists and not resume:
+            raise FileExistsError(f"{path} already holds Parquet parts; pass --resume or choose another --output_path.")
+        writer = ParquetWriter(path, template_name)
+        done = DoneKeys()
+        if resume:
+            done = DoneKeys(key_for(template_name, persona) for persona in writer.existing_personas())
+            print(f"Resuming: found {len(done)} finished personas in {path}")
+        return writer, done
+    if resume and os.path.exists(path):
+        dropped = drop_partial_line(path)
+        if dropped:
+            print(f"Dropped {dropped} bytes of a partially written record at the end of {path}")
+        done = load_done_keys(path, template_name)
+        print(f"Resuming: found {len(done)} finished personas in {path}")
+        return JsonlWriter(path, "a"), done
+    return JsonlWriter(path, "w"), DoneKeys()
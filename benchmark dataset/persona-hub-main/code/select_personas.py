@@ -0,0 +1,241 @@
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from dedup import shingles
+from persona_source import enumerate_personas
+
+VECTORS = "vectors.f16"
+PERSONAS = "personas.jsonl"
+META = "meta.json"
+
+
+class HashedTfidf:
+    """TF-IDF over hashed character n-grams, computed batch-wise with NumPy.
+
+    Every n-gram is hashed into one of `dim` buckets with a random sign, so no
+    vocabulary has to be built or kept. embed() returns sublinear term
+    frequencies; the IDF weights are only known after the whole dataset has
+    been seen, so build_index applies them in a second pass over the vectors.
+    """
+
+    needs_idf = True
+
+    def __init__(self, dim=512, ngram=4):
+        self.dim = dim
+        self.ngram = ngram
+        self.name = f"hashed-tfidf-{dim}-{ngram}"
+
+    def embed(self, texts):
+        hashes, offsets = shingles(texts, self.ngram)
+        counts = np.diff(np.append(offsets, len(hashes)))
+        rows = np.repeat(np.arange(len(texts), dtype=np.int64), counts)
+        buckets = (hashes % np.uint64(self.dim)).astype(np.int64)
+        signs = 1.0 - 2.0 * (hashes >> np.uint64(63)).astype(np.float64)
+        tf = np.bincount(rows * self.dim + buckets, weights=signs, minlength=len(texts) * self.dim)
+        tf = tf.reshape(len(texts), self.dim).astype(np.float32)
+        return np.sign(tf) * np.log1p(np.abs(tf))
+
+
+class SentenceEmbedder:
+    """A local sentence-transformers model (e.g. all-MiniLM-L6-v2) on the CPU."""
+
+    needs_idf = False
+
+    def __init__(self, model, batch_size=256, device="cpu"):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model, device=device)
+        self.batch_size = batch_size
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = model
+
+    def embed(self, texts):
+        return self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True,
+                                 convert_to_numpy=True, show_progress_bar=False).astype(np.float32)
+
+
+def build_index(personas, index_dir, embedder, batch_size=4096, chunk_size=65536):
+    """Embed (index, persona) pairs into `index_dir`; returns the number of rows.
+
+    Vectors are appended to a raw float16 file as they are computed, and the
+    personas to a JSONL file with the same row order, so neither the dataset
+    nor the vectors have to fit in memory.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    df = np.zeros(embedder.dim, dtype=np.int64)
+    rows = 0
+    start = time.monotonic()
+    with open(os.path.join(index_dir, VECTORS), "wb") as vectors, \
+            open(os.path.join(index_dir, PERSONAS), "w", encoding="utf-8") as texts:
+        def flush(batch):
+            nonlocal rows
+            x = embedder.embed([persona for _, persona in batch])
+            if embedder.needs_idf:
+                df[:] += np.count_nonzero(x, axis=0)
+            vectors.write(x.astype(np.float16).tobytes())
+            for index, persona in batch:
+                texts.write(json.dumps({"index": index, "persona": persona}, ensure_ascii=False) + "\n")
+            rows += len(batch)
+
+        batch = []
+        for item in personas:
+            batch.append(item)
+            if len(batch) == batch_size:
+                flush(batch)
+                batch = []
+                if rows % (batch_size * 100) == 0:
+                    print(f"Embedded {rows} personas ({rows / (time.monotonic() - start):.0f}/s)")
+        if batch:
+            flush(batch)
+
+    if embedder.needs_idf and rows:
+        # smoothed IDF, then unit length so that dot products are cosine similarities
+        idf = (np.log((1 + rows) / (1 + df)) + 1).astype(np.float32)
+        vectors = np.memmap(os.path.join(index_dir, VECTORS), dtype=np.float16, mode="r+", shape=(rows, embedder.dim))
+        for lo in range(0, rows, chunk_size):
+            x = vectors[lo:lo + chunk_size].astype(np.float32) * idf
+            x /= np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+            vectors[lo:lo + chunk_size] = x
+        vectors.flush()
+        del vectors
+    with open(os.path.join(index_dir, META), "w") as f:
+        json.dump({"rows": rows, "dim": embedder.dim, "embedder": embedder.name}, f)
+    return rows
+
+
+def load_index(index_dir):
+    """Return the read-only (rows, dim) float16 memmap of an index and its metadata."""
+    with open(os.path.join(index_dir, META)) as f:
+        meta = json.load(f)
+    if meta["rows"] == 0:
+        return np.zeros((0, meta["dim"]), dtype=np.float16), meta
+    return np.memmap(os.path.join(index_dir, VECTORS), dtype=np.float16, mode="r", shape=(meta["rows"], meta["dim"])), meta
+
+
+def farthest_points(x, k):
+    """Greedy k-center (farthest-point traversal) over the rows of `x`; returns row ids in selection order.
+
+    Starts from the row farthest from the centroid and then repeatedly adds the
+    row farthest from everything selected so far, which is within a factor 2
+    of the optimal k-center radius. Each step is one matrix-vector product
+    over `x`. Stops early when every remaining row duplicates a selected one.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    k = min(k, len(x))
+    if k == 0:
+        return np.zeros(0, dtype=np.int64)
+    sq = np.einsum("ij,ij->i", x, x)
+    # squared euclidean distance to the nearest selected row
+    centroid = x.mean(axis=0)
+    first = int(np.argmax(sq - 2 * (x @ centroid)))
+    nearest = sq - 2 * (x @ x[first]) + sq[first]
+    selected = [first]
+    for _ in range(1, k):
+        j = int(np.argmax(nearest))
+        if nearest[j] <= 1e-6:
+            break
+        selected.append(j)
+        np.minimum(nearest, sq - 2 * (x @ x[j]) + sq[j], out=nearest)
+    return np.array(selected, dtype=np.int64)
+
+
+def select_diverse(vectors, k, chunk_size=8192, oversample=2.0):
+    """Pick `k` rows of `vectors` that cover the whole set, in order of selection.
+
+    Up to `chunk_size` rows are handled exactly by farthest_points. Larger
+    inputs are split into chunks of that size. Each chunk contributes
+    farthest-point candidates in proportion to its size (`oversample` times
+    its share of k), and a final farthest-point pass over the candidates picks
+    the k rows. This is the two-round k-center scheme of Malkomes et al. (2015).
+    Only one chunk is in memory at a time. The first round costs about
+    k * oversample * chunk_size * dim whatever the number of rows, so small
+    chunks that stay in the CPU cache are much faster; they cost a little
+    coverage.
+    """
+    rows = len(vectors)
+    if rows <= chunk_size:
+        return farthest_points(vectors[:], k)
+    candidates = []
+    for lo in range(0, rows, chunk_size):
+        chunk = vectors[lo:lo + chunk_size]
+        quota = min(len(chunk), math.ceil(k * oversample * len(chunk) / rows))
+        candidates.append(lo + farthest_points(chunk, quota))
+    candidates = np.sort(np.concatenate(candidates))
+    return candidates[farthest_points(vectors[candidates], k)]
+
+
+def coverage(vectors, selected, chunk_size=65536):
+    """Return the mean and max cosine distance from every row to its nearest selected row."""
+    centers = np.asarray(vectors[np.sort(selected)], dtype=np.float32)
+    total, worst = 0.0, 0.0
+    for lo in range(0, len(vectors), chunk_size):
+        x = np.asarray(vectors[lo:lo + chunk_size], dtype=np.float32)
+        distance = 1.0 - (x @ centers.T).max(axis=1)
+        total += float(distance.sum())
+        worst = max(worst, float(distance.max()))
+    return total / max(1, len(vectors)), worst
+
+
+def write_subset(index_dir, selected, output_path):
+    """Write the selected personas to `output_path` in selection order, in the persona dataset's format."""
+    order = {int(row): rank for rank, row in enumerate(selected)}
+    records = [None] * len(selected)
+    with open(os.path.join(index_dir, PERSONAS), encoding="utf-8") as f:
+        for row, line in enumerate(f):
+            rank = order.get(row)
+            if rank is not None:
+                record = json.loads(line)
+                records[rank] = {"persona": record["persona"], "source_index": record["index"]}
+    with open(output_path, "w", encoding="utf-8") as out:
+        for record in records:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def main(args):
+    index_dir = args.index_dir or args.output_path + ".index"
+    if args.reuse_index and os.path.exists(os.path.join(index_dir, META)):
+        print(f"Reusing the persona index in {index_dir}")
+    else:
+        embedder = SentenceEmbedder(args.model, args.batch_size) if args.model else HashedTfidf(args.dim, args.ngram)
+        personas = enumerate_personas(args.dataset, args.data_files, offset=args.offset, limit=args.sample_size)
+        start = time.monotonic()
+        rows = build_index(personas, index_dir, embedder, args.batch_size)
+        print(f"Embedded {rows} personas with {embedder.name} in {time.monotonic() - start:.1f}s; index in {index_dir}")
+
+    vectors, meta = load_index(index_dir)
+    start = time.monotonic()
+    selected = select_diverse(vectors, args.subset_size, args.chunk_size, args.oversample)
+    print(f"Selected {len(selected)} of {meta['rows']} personas in {time.monotonic() - start:.1f}s")
+    if args.report_coverage and len(selected):
+        mean, worst = coverage(vectors, selected)
+        head_mean, head_worst = coverage(vectors, np.arange(len(selected)))
+        print(f"Cosine distance to the nearest selected persona: mean {mean:.3f}, max {worst:.3f} "
+              f"(first {len(selected)} personas: mean {head_mean:.3f}, max {head_worst:.3f})")
+    write_subset(index_dir, selected, args.output_path)
+    print(f"Outputted the subset to: {args.output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Select a maximally diverse subset of personas with greedy k-center selection.")
+    parser.add_argument('--subset_size', type=int, required=True, help='Number of personas to select.')
+    parser.add_argument('--output_path', type=str, required=True, help='JSONL file of the selected personas, most diverse first; pass it to a synthesize script as --dataset.')
+    parser.add_argument('--dataset', type=str, default="proj-persona/PersonaHub", help='HF dataset name, or a local .jsonl/.parquet file, directory or glob of personas.')
+    parser.add_argument('--data_files', type=str, default="persona.jsonl", help='Data files of the HF dataset to stream.')
+    parser.add_argument('--offset', type=int, default=0, help='Number of personas to skip at the start of the dataset.')
+    parser.add_argument('--sample_size', type=int, default=0, help='Number of personas to select from; 0 means all of them.')
+    parser.add_argument('--index_dir', type=str, default="", help='Where the vectors and personas are stored; defaults to <output_path>.index.')
+    parser.add_argument('--reuse_index', action='store_true', help='Select from an existing index instead of embedding the personas again.')
+    parser.add_argument('--model', type=str, default="", help='sentence-transformers model run on the CPU, e.g. sentence-transformers/all-MiniLM-L6-v2; empty uses hashed TF-IDF.')
+    parser.add_argument('--dim', type=int, default=512, help='Number of hashed TF-IDF dimensions.')
+    parser.add_argument('--ngram', type=int, default=4, help='Character n-gram size of the hashed TF-IDF features.')
+    parser.add_argument('--batch_size', type=int, default=4096, help='Personas embedded at a time.')
+    parser.add_argument('--chunk_size', type=int, default=8192, help='Rows per chunk in the first selection round; larger chunks are slower but cover slightly better.')
+    parser.add_argument('--oversample', type=float, default=2.0, help='Candidates kept per chunk, as a multiple of its share of --subset_size.')
+    parser.add_argument('--report_coverage', action='store_true', help='Compare the coverage of the subset with that of the first --subset_size personas.')
+    args = parser.parse_args()
+    main(args)
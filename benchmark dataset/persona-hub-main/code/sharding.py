@@ -0,0 +1,13 @@
+import hashlib
+import os
+
+
+def shard_of(persona, num_shards):
+    """Stable shard assignment of a persona; independent of its position and of the process."""
+    digest = hashlib.blake2b(persona.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % num_shards
+
+
+def shard_path(output_path, shard_index, num_shards):
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.shard{shard_index:05d}-of-{num_shards:05d}{ext or '.jsonl'}"
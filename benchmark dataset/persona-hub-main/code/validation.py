@@ -0,0 +1,97 @@
+import json
+import os
+import re
+from collections import Counter
+
+from metrics import RunMetrics
+from prompt_templates import response_headings
+
+# markdown that models like to wrap the heading in, e.g. "**Math problem:**" or "## Title:"
+DECORATION = re.compile(r"[\s*#_>`]*")
+
+
+def check_response(template_name, text, finish_reason=None):
+    """Return why a response breaks its template's contract, or None if it is fine.
+
+    A response is invalid when it was cut off by the token budget, is empty,
+    or does not start with the heading its template asks for (see
+    prompt_templates.response_headings; templates without one only get the
+    first two checks).
+    """
+    if finish_reason == "length":
+        return "truncated"
+    if text is None or not text.strip():
+        return "empty"
+    heading = response_headings.get(template_name)
+    if heading:
+        body = text[DECORATION.match(text).end():]
+        if not body.lower().startswith(heading.lower()):
+            return "missing_heading"
+        if not DECORATION.sub("", body[len(heading):], count=1).strip():
+            return "empty"
+    return None
+
+
+class Validator:
+    """Checks responses as they stream in and decides which ones to generate again.
+
+    A response that fails check_response is retried until the persona has had
+    `max_attempts` generations; after that it is appended with the reason to
+    `rejects_path` (which may contain a {template} placeholder) instead of
+    the output, so a later --resume run picks the persona up again.
+    """
+
+    def __init__(self, max_attempts=3, rejects_path="", resume=False, metrics=None):
+        self.max_attempts = max_attempts
+        self.rejects_path = rejects_path
+        self.resume = resume
+        self.metrics = metrics or RunMetrics()
+        self.invalid = Counter()
+        self.rejected = Counter()
+        self.files = {}
+
+    def check(self, template_name, text, finish_reason=None):
+        reason = check_response(template_name, text, finish_reason)
+        if reason is not None:
+            self.invalid[reason] += 1
+            self.metrics.count("invalid_responses")
+        return reason
+
+    def retry(self, attempt):
+        """Whether a response that failed on `attempt` (counted from 0) is generated again."""
+        return attempt + 1 < self.max_attempts
+
+    def reject(self, template_name, record, reason):
+        self.rejected[reason] += 1
+        self.metrics.count("rejected")
+        if not self.rejects_path:
+            return
+        path = self.rejects_path.replace("{template}", template_name)
+        if path not in self.files:
+            self.files[path] = open(path, "a" if self.resume else "w", encoding="utf-8")
+        self.files[path].write(json.dumps({**record, "rejected": reason}, ensure_ascii=False) + "\n")
+
+    def flush(self):
+        for f in self.files.values():
+            f.flush()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def summary(self):
+        return f"invalid responses: {dict(self.invalid)}, rejected after {self.max_attempts} attempts: {dict(self.rejected)}"
+
+
+def make_validator(args, rejects_path, template_names, metrics):
+    """Build the Validator for a script's arguments; None with --no_validation."""
+    if args.no_validation:
+        return None
+    if not args.resume:
+        # rejects of an earlier run would otherwise stay around when this one has none
+        for name in template_names:
+            path = rejects_path.replace("{template}", name)
+            if os.path.exists(path):
+                os.remove(path)
+    return Validator(args.invalid_retries + 1, rejects_path, args.resume, metrics)
@@ -1,79 +1,221 @@
 import argparse
-from transformers import AutoTokenizer
-import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain, islice
 from tqdm import tqdm
-from vllm import LLM, SamplingParams
-from datasets import load_dataset
-from code.prompt_templates import instruction_template, knowledge_template, npc_template, math_template
+from code.prompt_templates import templates, token_budgets
+from code.resume import open_output
+from code.output_writers import FORMATS as OUTPUT_FORMATS
+from code.persona_source import enumerate_personas
+from code.dedup import dedup_personas
+from code.prompt_cache import PrefixTokenizer
+from code.response_cache import ResponseCache, make_key, MODES as CACHE_MODES
+from code.metrics import RunMetrics
+from code.backends import record_outputs, LENGTH_BUCKET
+from code.validation import check_response, make_validator
+
+system_prompt = "You are a helpful assistant."
 
 def request_input_format(user_prompt, tokenizer):
-    system_prompt = "You are a helpful assistant."
     messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": user_prompt}]
     text = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
     return text
 
+def iter_chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def prepare_chunk(chunks, prefix_tokenizer, cache, cache_params, metrics):
+    # reading the next personas from the stream also happens off the main thread
+    with metrics.stage("load"):
+        chunk = next(chunks, [])
+    indices = [index for index, _ in chunk]
+    personas = [persona for _, persona in chunk]
+    # the chat template already contains the special tokens, so they are never added twice
+    with metrics.stage("prompt"):
+        prompts, token_ids = prefix_tokenizer(personas)
+    keys, cached = [], []
+    if cache is not None:
+        with metrics.stage("cache"):
+            keys = [make_key(*cache_params, prefix_tokenizer.template.format(persona=persona)) for persona in personas]
+            cached = [cache.get(key) for key in keys]
+        metrics.count("cache_hits", sum(text is not None for text in cached))
+    return indices, personas, prompts, token_ids, keys, cached
+
+def synthesize(llm, prefix_tokenizer, sampling_params, chunks, out, args, cache=None, cache_params=None, metrics=None,
+               validator=None):
+    """Generate and write chunk after chunk; returns the number of records written.
+
+    `llm` only needs vLLM's generate(prompts, sampling_params, use_tqdm) so the
+    loop also runs against mock_backend.MockLLM. With a validation.Validator,
+    personas whose response fails it are generated again, in further generate
+    calls on just those rows, before the chunk is written (or rejected once
+    they run out of attempts), so the output stays in input order.
+    """
+    metrics = metrics or RunMetrics()
+    validate = partial(check_response, args.template) if validator is not None else None
+    total = 0
+    progress = tqdm(total=args.sample_size or None)
+    # chunk N+1 is rendered and tokenized in a worker thread while chunk N is generating
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(prepare_chunk, chunks, prefix_tokenizer, cache, cache_params, metrics)
+        while True:
+            chunk_indices, chunk_personas, prompts, token_ids, keys, cached = pending.result()
+            if not chunk_personas:
+                break
+            pending = pool.submit(prepare_chunk, chunks, prefix_tokenizer, cache, cache_params, metrics)
+            if total == 0 and progress.n == 0:
+                print(f"Sample 0: {prompts[0]}")
+
+            # only cache misses go to the model; cached responses are always complete ("stop") ones
+            results = [(text, "stop") if text is not None and (validate is None or validate(text, "stop") is None) else None
+                       for text in cached] or [None] * len(chunk_personas)
+            reasons = [None] * len(chunk_personas)
+            attempts = [0] * len(chunk_personas)
+            todo = [i for i, result in enumerate(results) if result is None]
+            generated = set(todo)
+            while todo:
+                # prompts of similar length are scheduled together, so the sequences of a batch finish at similar times
+                todo.sort(key=lambda i: len(token_ids[i]) // LENGTH_BUCKET)
+                start = time.monotonic()
+                with metrics.stage("generate"):
+                    outputs = llm.generate([{"prompt_token_ids": token_ids[i]} for i in todo], sampling_params, use_tqdm=False)
+                record_outputs(metrics, outputs, time.monotonic() - start)
+                for i, output in zip(todo, outputs):
+                    results[i] = (output.outputs[0].text, output.outputs[0].finish_reason)
+                    if validator is not None:
+                        reasons[i] = validator.check(args.template, *results[i])
+                # only the rows that failed go back to the model
+                todo = [i for i in todo if reasons[i] is not None and validator.retry(attempts[i])]
+                for i in todo:
+                    attempts[i] += 1
+
+            written = 0
+            with metrics.stage("write"):
+                for i, (index, persona, prompt, (out_txt, finish_reason)) in enumerate(zip(chunk_indices, chunk_personas, prompts, results)):
+                    data = {'prompt': prompt, "input persona": persona, "finish_reason": finish_reason}
+                    data['synthesized text'] = out_txt
+                    if args.num_shards > 1:
+                        # lets merge_shards.py restore the original persona order
+                        data["persona_index"] = index
+                    if reasons[i] is not None:
+                        validator.reject(args.template, data, reasons[i])
+                        continue
+                    if cache is not None and i in generated and finish_reason == "stop":
+                        cache.put(keys[i], out_txt)
+                    out.write(data)
+                    written += 1
+                # each finished chunk is on disk before the next one starts; Parquet rows once their row group is full
+                out.flush()
+                if validator is not None:
+                    validator.flush()
+            metrics.count("records", written)
+            total += written
+            progress.update(len(chunk_personas))
+    progress.close()
+    return total
+
 def main(args):
     # Load the appropriate template
-    if args.template == "instruction":
-        template = instruction_template
-    elif args.template == "knowledge":
-        template = knowledge_template
-    elif args.template == "npc":
-        template = npc_template
-    elif args.template == "math":
-        template = math_template
-    else:
-        raise ValueError("Invalid template type. Choose from 'instruction', 'knowledge', 'math' or 'npc'.")
-
-    # Load the dataset
-    persona_dataset = load_dataset("proj-persona/PersonaHub", data_files="persona.jsonl")['train']
-    if args.sample_size > 0:
-        persona_dataset = persona_dataset[:args.sample_size]
-    print(f"Total number of input personas: {len(persona_dataset['persona'])}")
-
-    # Load the model and tokenizer
-    model_path = args.model_path
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    llm = LLM(model=model_path, tensor_parallel_size=4) # please set tensor_parallel_size based on the GPUs you are using
+    template = templates[args.template]
 
-    prompts = []
-    max_len = 2048
+    if not 0 <= args.shard_index < args.num_shards:
+        raise ValueError(f"--shard_index must be in [0, {args.num_shards}).")
 
-    for persona in persona_dataset['persona']:
-        persona = persona.strip()
-        user_prompt = template.format(persona=persona)
-        prompt = request_input_format(user_prompt, tokenizer)
-        prompts.append(prompt)
+    # Stream the dataset
+    personas = enumerate_personas(args.dataset, args.data_files, offset=args.offset, limit=args.sample_size,
+                                  num_shards=args.num_shards, shard_index=args.shard_index)
+    if args.dedup_personas:
+        # drop near-duplicate personas before any request is made for them
+        personas = dedup_personas(personas, args.output_path + ".persona_clusters.jsonl",
+                                  index_dir=args.dedup_index_dir or None)
+    out, done = open_output(args.output_path, args.template, args.resume, args.output_format)
+    if done:
+        personas = done.filter(args.template, personas)
+    chunks = iter_chunks(personas, args.chunk_size)
+    # peek at the first chunk so a finished --resume run does not load the model
+    first = next(chunks, None)
+    if first is None:
+        out.close()
+        print(f"Nothing left to synthesize in: {args.output_path}")
+        return
+    chunks = chain([first], chunks)
 
-    print(f"Loaded {len(prompts)} entries to process...\n\n")
-    print(f"Sample 0: {prompts[0]}")
+    # Load the model and tokenizer; imported here so bench_pipeline.py can run the loop without them
+    from transformers import AutoTokenizer
+    from vllm import LLM, SamplingParams
+
+    model_path = args.model_path
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    # prefix caching lets vLLM reuse the KV cache of the shared system prompt and template preamble
+    llm = LLM(model=model_path, tensor_parallel_size=args.tensor_parallel_size, enable_prefix_caching=not args.disable_prefix_cache)
+    prefix_tokenizer = PrefixTokenizer(tokenizer, template, lambda user_prompt: request_input_format(user_prompt, tokenizer),
+                                       enabled=not args.disable_prefix_cache)
 
+    # a budget per template keeps a runaway generation from holding KV-cache blocks for 2048 tokens
+    max_len = args.max_tokens or token_budgets.get(args.template, 2048)
     sampling_params = SamplingParams(temperature=0.6, top_p=0.95, max_tokens=max_len, stop=["<|eot_id|>"])
-    outputs = llm.generate(prompts, sampling_params)
+    cache = ResponseCache(args.cache_path, mode=args.cache_mode, max_bytes=args.cache_max_mb * 1024 * 1024) if args.cache_path else None
+    cache_params = (model_path, sampling_params.temperature, system_prompt)
 
-    with open(args.output_path, 'w') as out:
-        for i, output in enumerate(outputs):
-            out_txt = output.outputs[0].text
-            finish_reason = output.outputs[0].finish_reason
-            data = {'prompt': output.prompt, "input persona": persona_dataset['persona'][i].strip(), "finish_reason": finish_reason}
-            data['synthesized text'] = out_txt
-            out.write(json.dumps(data, ensure_ascii=False) + '\n')
+    metrics = RunMetrics(labels={"script": "vllm", "template": args.template, "shard": args.shard_index},
+                         path=args.metrics_path, interval=args.metrics_interval, profile_dir=args.profile_dir)
+    validator = make_validator(args, args.output_path + ".rejected.jsonl", [args.template], metrics)
+    with out:
+        total = synthesize(llm, prefix_tokenizer, sampling_params, chunks, out, args, cache, cache_params, metrics, validator)
+    if validator is not None:
+        validator.close()
+        print(f"Validation: {validator.summary()}")
+    if cache is not None:
+        cache.close()
+        print(f"Response cache: {cache.stats()}")
+    metrics.close()
+    summary = metrics.summary()
+    print(f"Generated {summary['counters'].get('completion_tokens', 0)} tokens "
+          f"({summary['completion_tokens_per_sec']:.1f}/s), finish reasons: {summary['finish_reasons']}")
 
+    print(f"Synthesized {total} entries")
     print(f"Outputted the results to: {args.output_path}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Synthesize text using a specified model and template.")
     parser.add_argument('--sample_size', type=int, default=0, help='Number of samples to process from the dataset; Set it to 0 if you want to use the full set of 200k personas.')
+    parser.add_argument('--dataset', type=str, default="proj-persona/PersonaHub", help='HF dataset name, or a local .jsonl/.parquet file, directory or glob of personas.')
+    parser.add_argument('--data_files', type=str, default="persona.jsonl", help='Data files of the HF dataset to stream, e.g. persona.jsonl or ElitePersonas/*.jsonl.')
+    parser.add_argument('--offset', type=int, default=0, help='Number of personas to skip at the start of the dataset.')
     parser.add_argument('--model_path', type=str, required=True, help='Path to the model.')
     parser.add_argument('--output_path', type=str, required=True, help='Path to the output file.')
+    parser.add_argument('--output_format', type=str, default="jsonl", choices=OUTPUT_FORMATS, help='jsonl, or parquet for a directory of zstd-compressed Parquet files.')
+    parser.add_argument('--tensor_parallel_size', type=int, default=4, help='Number of GPUs the model is split over; set it based on the GPUs you are using.')
+    parser.add_argument('--num_shards', type=int, default=1, help='Split the dataset into this many shards by a stable persona hash.')
+    parser.add_argument('--shard_index', type=int, default=0, help='Shard processed by this worker, in [0, num_shards).')
+    parser.add_argument('--dedup_personas', action='store_true', help='Skip near-duplicate personas (MinHash/LSH); clusters are written next to the output file.')
+    parser.add_argument('--dedup_index_dir', type=str, default="", help='Keep the --dedup_personas index in memory-mapped files in this directory instead of RAM.')
+    parser.add_argument('--resume', action='store_true', help='Append to an existing output file and skip personas it already contains.')
+    parser.add_argument('--cache_path', type=str, default="", help='SQLite file used to cache responses across runs; empty disables the cache.')
+    parser.add_argument('--cache_mode', type=str, default="readwrite", choices=CACHE_MODES, help='Read-through, write-through or both.')
+    parser.add_argument('--cache_max_mb', type=int, default=0, help='Size cap of the cache in MB with LRU eviction; 0 means unbounded.')
+    parser.add_argument('--disable_prefix_cache', action='store_true', help='Tokenize every prompt in full and turn off vLLM prefix caching.')
+    parser.add_argument('--chunk_size', type=int, default=4096, help='Number of personas per generate call; each chunk is written out as soon as it finishes.')
+    parser.add_argument('--max_tokens', type=int, default=0, help='Token budget of a response; 0 uses the template\'s budget in prompt_templates.token_budgets.')
+    parser.add_argument('--invalid_retries', type=int, default=2, help='Times a truncated or malformed response is generated again (within its chunk) before the persona goes to <output_path>.rejected.jsonl.')
+    parser.add_argument('--no_validation', action='store_true', help='Write every response as it is, without checking the template\'s format.')
+    parser.add_argument('--metrics_path', type=str, default="", help='Export metrics to <metrics_path>.prom (Prometheus textfile) and <metrics_path>.json.')
+    parser.add_argument('--metrics_interval', type=float, default=30.0, help='Seconds between metrics exports.')
+    parser.add_argument('--profile_dir', type=str, default="", help='Run each pipeline stage under cProfile and write <stage>.prof files here.')
     parser.add_argument(
         '--template', 
         type=str, 
         required=True, 
-        choices=['instruction', 'knowledge', 'npc', 'math'], 
+        choices=list(templates), 
         help=(
             "Prompt templates. Choose from 'instruction', 'knowledge', 'math' or 'npc'. "
-            "You can also add more customized templates in code/templates.py"
+            "You can also add more customized templates to `templates` in code/prompt_templates.py"
         )
     )
     args = parser.parse_args()